@@ -0,0 +1,68 @@
+"""
+Time the tree builder on generated programs of increasing length
+
+    python benchmark.py
+    python benchmark.py 1000 10000 100000
+    python benchmark.py --gc 100000
+
+Each program is a main that fills a lookup table and runs a long sequence of
+assignments, the shape of unrolled generated code. The time per statement
+should stay the same as the programs get longer.
+
+The garbage collector is paused while each program is parsed, unless --gc is
+given. A parse creates no reference cycles, but the collector rescans
+everything parsed so far each time it runs, so with it on the time per
+statement grows with the file. This process only parses, so it's safe to
+turn it off here. Other callers can do the same around build_tree.
+"""
+import gc
+import os
+import sys
+import tempfile
+import time
+
+from tree_builder.tree_builder import build_tree
+
+
+def generate(statements):
+    """
+    A program of `statements` statements in one sub
+
+    :param statements:
+    :return: source code
+    """
+    lines = ["sub main", "    int table[16] = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]", "    int x = 1"]
+    for i in range(statements):
+        if i % 2:
+            lines.append("    table[%d] = x + %d" % (i % 16, i % 1000))
+        else:
+            lines.append("    x = (x * %d) - table[%d]" % (i % 7, i % 16))
+    return "\n".join(lines) + "\n"
+
+
+def benchmark(sizes, memoise=True, collect=False):
+    print("{:>10} {:>10} {:>16}".format("statements", "seconds", "us per statement"))
+    for statements in sizes:
+        fd, filename = tempfile.mkstemp(suffix=".txt")
+        enabled = gc.isenabled()
+        try:
+            with os.fdopen(fd, "w") as source:
+                source.write(generate(statements))
+            if not collect:
+                gc.disable()
+            start = time.perf_counter()
+            build_tree(filename, memoise)
+            taken = time.perf_counter() - start
+        finally:
+            if enabled:
+                gc.enable()
+            os.remove(filename)
+        print("{:>10} {:>10.2f} {:>16.1f}".format(statements, taken, taken / statements * 1e6))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    memoise = "--no-memoise" not in args
+    collect = "--gc" in args
+    sizes = [int(arg) for arg in args if not arg.startswith("--")]
+    benchmark(sizes or [1000, 10000, 100000], memoise, collect)
@@ -2,14 +2,28 @@ import sys
 
 from tree_builder.tree_builder import build_tree
 from high_level_compiler.high_level_compiler import FileInterpreter as HighLevelFileInterpreter
+from high_level_compiler.incremental import IncrementalFileInterpreter
 from low_level_compiler.low_level_compiler import FileInterpreter as LowLevelFileInterpreter
 
 class Compiler:
-    def __init__(self, filename):
-        high_level_file_interpreter = HighLevelFileInterpreter(build_tree(filename))
+    def __init__(self, filename, optimisations=None, cache_dir=None):
+        """
+        Compile a file to QFTASM
+
+        :param filename:
+        :param optimisations: passed on to the low level FileInterpreter
+        :param cache_dir: directory to cache each sub's high level instructions in, to only compile the subs
+            that change from one build to the next. None to compile everything
+        """
+        if cache_dir is None:
+            high_level_file_interpreter = HighLevelFileInterpreter(build_tree(filename))
+        else:
+            high_level_file_interpreter = IncrementalFileInterpreter(filename, cache_dir)
+        self.high_level_file_interpreter = high_level_file_interpreter
         compiled = high_level_file_interpreter.compile()
         self.low_level_file_interpreter = LowLevelFileInterpreter(compiled,
-                                                                  high_level_file_interpreter.global_store)
+                                                                  high_level_file_interpreter.global_store,
+                                                                  optimisations)
 
 if __name__ == "__main__":
     """
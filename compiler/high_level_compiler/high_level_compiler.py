@@ -168,14 +168,26 @@ class GlobalLocalStoreHelper:
 
 
 class FileInterpreter:
-    def __init__(self, tree: GrammarTree):
+    def __init__(self, tree: GrammarTree, require_main: bool = True):
+        """
+        Interpret every statement of a file
+
+        :param tree:
+        :param require_main: False for a module of a program that has its main elsewhere
+        """
+        self.setup()
+        for stmt in tree["stmts"]:
+            self.add_stmt(stmt)
+        if require_main:
+            assert "main" in [sub.name for sub in self.subs]
+
+    def setup(self):
         self.file_types = {
             "sub": SubroutineInterpreter,
             "inline": InlineInterpreter,
             "struct": None,
             "newline": DummyInterpreter
         }
-        stmts = tree["stmts"]
         self.global_store = VariableStore()
         self.subs = []
         self.structs = []
@@ -184,9 +196,9 @@ class FileInterpreter:
                       "struct": self.structs,
                       "inline": self.inlines,
                       "newline": []}
-        for stmt in stmts:
-            self.lists[stmt["_block_name"]].append(self.file_types[stmt["_block_name"]](self.global_store, self.inlines, stmt))
-        assert "main" in [sub.name for sub in self.subs]
+
+    def add_stmt(self, stmt: GrammarTree):
+        self.lists[stmt["_block_name"]].append(self.file_types[stmt["_block_name"]](self.global_store, self.inlines, stmt))
 
     def __repr__(self):
         rtn = "\n\n".join(str(sub) for sub in self.subs)
@@ -195,7 +207,7 @@ class FileInterpreter:
     def compile(self):
         rtn = []
         for sub in sorted(self.subs, key=lambda sub: sub.name == "main", reverse=True):
-            rtn.extend(sub.compile())
+            rtn.extend(self.compile_sub(sub))
         for sub in self.subs:
             sub.local_store.finalise()
             for var in sub.local_store.offsets:
@@ -228,6 +240,9 @@ class FileInterpreter:
         #print(self.global_store)
         return rtn
 
+    def compile_sub(self, sub: "SubroutineInterpreter") -> list:
+        return sub.compile()
+
 
 class SubroutineInterpreter:
     def __init__(self, global_store: VariableStore, inlines, tree: GrammarTree):
@@ -0,0 +1,222 @@
+"""
+Compile only the subs that have changed since the last build
+
+Each sub's high level instructions are cached on disk, under a hash of
+- its tokens
+- the tokens of every operator, as any of them could be inlined into it
+- the global variables declared before it, which its names could refer to
+
+The subs that hash the same as in an earlier build aren't parsed or compiled
+again, only loaded. Everything after the high level compiler runs on the
+whole program as before, as RAM and instruction addresses are only given out
+once every sub is known.
+
+Variables shared with the rest of the program are cached as references and
+looked up in the new build: the scratchpads by their position, the global
+variables by name and the variables of operators by the operator and name.
+Everything the sub has to itself, its own variables and the globals it
+declares, is cached as it is.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+
+from high_level_compiler.high_level_compiler import FileInterpreter, IfInterpreter, WhileInterpreter
+from high_level_compiler.variables import Variable, ScratchVariable, PointerVariable, ReferenceVariable, \
+    VariableStore
+from tree_builder.tree_builder import UnitParser
+
+# Change to ignore everything cached by an older compiler
+cache_version = 1
+
+
+class CachedSubroutine:
+    def __init__(self, name: str, local_store: VariableStore, instructions: list):
+        """
+        Stands in for a SubroutineInterpreter loaded from the cache
+
+        :param name:
+        :param local_store:
+        :param instructions: the high level instructions it compiles to
+        """
+        self.name = name
+        self.local_store = local_store
+        self.instructions = instructions
+
+    def compile(self):
+        return self.instructions
+
+
+class SubroutinePickler(pickle.Pickler):
+    def __init__(self, file, file_interpreter: "IncrementalFileInterpreter", local_store: VariableStore,
+                 declared: list):
+        """
+        Pickle a sub's instructions with references to the variables it shares
+
+        :param file:
+        :param file_interpreter:
+        :param local_store: the sub's variables
+        :param declared: global variables the sub declares
+        """
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.file_interpreter = file_interpreter
+        self.own = set(map(id, local_store._vars.values())) | set(map(id, declared))
+        global_store = file_interpreter.global_store
+        self.global_store = global_store
+        self.operators = {}
+        for i, inline in enumerate(file_interpreter.inlines):
+            for name, variable in inline.local_store._vars.items():
+                self.operators[id(variable)] = i, name
+        self.globals = {id(variable): name for name, variable in global_store._vars.items()}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, Variable) or id(obj) in self.own or isinstance(obj, (PointerVariable,
+                                                                                   ReferenceVariable)):
+            return None
+        if id(obj) in self.globals:
+            return "global", self.globals[id(obj)]
+        if id(obj) in self.operators:
+            return ("operator",) + self.operators[id(obj)]
+        if isinstance(obj, ScratchVariable):
+            index = self.global_store.scratchpad_index(obj)
+            if index is not None:
+                return "scratchpad", index
+        raise pickle.PicklingError("Can't cache a reference to {!r}".format(obj))
+
+
+class SubroutineUnpickler(pickle.Unpickler):
+    def __init__(self, file, file_interpreter: "IncrementalFileInterpreter"):
+        super().__init__(file)
+        self.file_interpreter = file_interpreter
+        # The variable each reference has been looked up as
+        self.loaded = {}
+
+    def persistent_load(self, pid):
+        if pid not in self.loaded:
+            self.loaded[pid] = self.find(pid)
+        return self.loaded[pid]
+
+    def find(self, pid) -> Variable:
+        global_store = self.file_interpreter.global_store
+        if pid[0] == "global":
+            return global_store[pid[1]]
+        if pid[0] == "scratchpad":
+            return global_store.get_scratchpad(pid[1])
+        inline = self.file_interpreter.inlines[pid[1]]
+        if pid[2] not in inline.local_store:
+            # Its variables are only added the first time it's compiled
+            inline.compile()
+        return inline.local_store[pid[2]]
+
+
+class IncrementalFileInterpreter(FileInterpreter):
+    def __init__(self, filename: str, cache_dir: str):
+        """
+        Load the subs that are cached, and parse the rest
+
+        :param filename:
+        :param cache_dir: directory to keep the cached subs in
+        """
+        self.setup()
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        # Names of the subs loaded from the cache, and of the ones compiled
+        self.reused = []
+        self.recompiled = []
+        # Sub: (cache file, global variables it declares) for each sub to compile and cache
+        self.to_cache = {}
+        parser = UnitParser(filename)
+        tokens = parser.state.tokens
+        subs = [unit for unit in parser.units if tokens[unit[0]].string == "sub"]
+        operators = hashlib.sha256(str(cache_version).encode())
+        # Operators first, so they're there to inline and to look up variables in when loading subs
+        for unit in parser.units:
+            if unit not in subs:
+                operators.update(parser.text(unit).encode())
+                self.add_stmt(parser.parse(unit))
+        # Global variables declared so far
+        declared = []
+        for unit in subs:
+            key = hashlib.sha256(operators.digest())
+            key.update(repr(declared).encode())
+            key.update(parser.text(unit).encode())
+            path = os.path.join(cache_dir, key.hexdigest() + ".pickle")
+            try:
+                with open(path, "rb") as cache_file:
+                    name, local_store, globals_declared, scratchpads, instructions = \
+                        SubroutineUnpickler(cache_file, self).load()
+            except (OSError, pickle.UnpicklingError, EOFError):
+                before = set(self.global_store._vars)
+                self.add_stmt(parser.parse(unit))
+                sub = self.subs[-1]
+                globals_declared = [variable for name, variable in self.global_store._vars.items()
+                                    if name not in before]
+                self.to_cache[sub] = path, globals_declared
+                self.recompiled.append(sub.name)
+            else:
+                for variable in globals_declared:
+                    self.global_store.add_named(variable)
+                if scratchpads:
+                    self.global_store.get_scratchpad(scratchpads - 1)
+                self.subs.append(CachedSubroutine(name, local_store, self.relabel(instructions)))
+                self.reused.append(name)
+            declared.extend(globals_declared)
+        assert "main" in [sub.name for sub in self.subs]
+
+    @staticmethod
+    def relabel(instructions: list) -> list:
+        """
+        Give the ifs and whiles of a loaded sub new ids, which no other sub in this build has
+
+        :param instructions:
+        :return:
+        """
+        ids = {}
+        rtn = []
+        for instruction in instructions:
+            if instruction[0] in ("if", "while"):
+                key = instruction[0], instruction[2]
+                if key not in ids:
+                    ids[key] = next((IfInterpreter if key[0] == "if" else WhileInterpreter).id_gen)
+                instruction = instruction[:2] + (ids[key],) + instruction[3:]
+            rtn.append(instruction)
+        return rtn
+
+    def compile_sub(self, sub) -> list:
+        """
+        Compile a sub, and cache it if it wasn't loaded from the cache
+
+        :param sub:
+        :return:
+        """
+        self.global_store.scratchpads_needed = 0
+        instructions = sub.compile()
+        if sub in self.to_cache:
+            path, globals_declared = self.to_cache.pop(sub)
+            self.save(path, sub.name, sub.local_store, globals_declared, self.global_store.scratchpads_needed,
+                      instructions)
+        return instructions
+
+    def save(self, path: str, name: str, local_store: VariableStore, globals_declared: list, scratchpads: int,
+             instructions: list):
+        """
+        Write a sub to the cache, all at once so no other build reads half of it
+
+        :param path:
+        :param name:
+        :param local_store:
+        :param globals_declared:
+        :param scratchpads: how many scratchpads compiling it needed, some of which it might not refer to
+        :param instructions:
+        :return:
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as cache_file:
+                SubroutinePickler(cache_file, self, local_store, globals_declared).dump(
+                    (name, local_store, globals_declared, scratchpads, instructions))
+            os.replace(temp_path, path)
+        except pickle.PicklingError:
+            # Not cached, so it's compiled again next time
+            os.remove(temp_path)
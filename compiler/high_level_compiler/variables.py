@@ -1,3 +1,5 @@
+from typing import Optional
+
 from tree_builder.tree_builder import GrammarTree
 
 
@@ -13,6 +15,8 @@ class VariableStore:
     def __init__(self):
         self._vars = {}
         self._scratchpads = []
+        # How many of the scratchpads, from the first, have been used since this was last set to 0
+        self.scratchpads_needed = 0
 
     def __contains__(self, item):
         try:
@@ -79,14 +83,35 @@ class VariableStore:
         return rtn
 
     def add_scratchpad(self, type="int"):
-        for scratchpad in self._scratchpads:
+        for i, scratchpad in enumerate(self._scratchpads):
             if scratchpad.being_used is False:
                 scratchpad.being_used = True
+                self.scratchpads_needed = max(self.scratchpads_needed, i + 1)
                 return scratchpad
         rtn = ScratchVariable(type)
         self._scratchpads.append(rtn)
+        self.scratchpads_needed = max(self.scratchpads_needed, len(self._scratchpads))
         return rtn
 
+    def get_scratchpad(self, index: int) -> "ScratchVariable":
+        """
+        The scratchpad at `index` in the order they were added, adding free ones up to it
+
+        :param index:
+        :return:
+        """
+        while len(self._scratchpads) <= index:
+            scratchpad = ScratchVariable("int")
+            scratchpad.free()
+            self._scratchpads.append(scratchpad)
+        return self._scratchpads[index]
+
+    def scratchpad_index(self, variable: "Variable") -> Optional[int]:
+        for i, scratchpad in enumerate(self._scratchpads):
+            if scratchpad is variable:
+                return i
+        return None
+
     def add_subroutine(self, variable: "CustomVariable"):
         self._scratchpads.append(variable)
 
@@ -0,0 +1,203 @@
+"""
+Compile the files of a program on their own and link them together
+
+    python linker.py main.txt maths.txt
+    python linker.py -c maths.txt
+    python linker.py main.txt maths.qobj
+
+Each file compiles to an ObjectModule, whose RAM addresses and labels are left
+for the linker to fill in. Its addresses are written "@symbol+n": n words
+after the start of the module's variables if there's no symbol, otherwise
+after an address shared between modules, which are
+- "<result>" and "<stack>", the result register and stack pointer
+- "sub.i", the ith parameter of a sub in another module
+Subs are called by their "Start sub" label as before, and the linker prefixes
+every other label with the module's position so they can't clash.
+
+The linker puts the variables of each module one after the other in RAM,
+followed by the result register and the stack, and the main module's code
+first. The peephole passes run on the linked program, but everything else
+only sees one module, so a call to a sub in another module is compiled as if
+the sub could write any variable. Global variables belong to the module
+that declares them.
+
+Modules are compiled in separate processes, and -c saves a module to link
+into any number of programs without compiling it again.
+"""
+import os
+import pickle
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from tree_builder.tree_builder import build_tree
+from high_level_compiler.high_level_compiler import FileInterpreter as HighLevelFileInterpreter
+from low_level_compiler.low_level_compiler import FileInterpreter as LowLevelFileInterpreter
+from low_level_compiler.peephole import PeepholeOptimiser
+
+# An address for the linker to fill in
+address_pattern = re.compile(r"@([^\s+]*)\+(\d+)")
+
+
+class ObjectModule:
+    def __init__(self, filename: str, code: list, size: int, exports: dict, imports: set, variables: dict):
+        """
+        One file's code, before it's linked into a program
+
+        :param filename:
+        :param code: instructions and "#label" entries
+        :param size: number of words of RAM its variables take
+        :param exports: sub: address of each of its parameters, relative to the module's variables
+        :param imports: subs it calls in other modules
+        :param variables: name: address relative to the module's variables
+        """
+        self.filename = filename
+        self.code = code
+        self.size = size
+        self.exports = exports
+        self.imports = imports
+        self.variables = variables
+
+    def save(self, filename: str):
+        with open(filename, "wb") as object_file:
+            pickle.dump(self, object_file, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename: str) -> "ObjectModule":
+        with open(filename, "rb") as object_file:
+            return pickle.load(object_file)
+
+
+def compile_module(filename: str, optimisations=None) -> ObjectModule:
+    """
+    Compile a file which can call subs in other modules
+
+    :param filename:
+    :param optimisations: the ones the low level FileInterpreter compiles with, the rest are for the Linker
+    :return:
+    """
+    high_level_file_interpreter = HighLevelFileInterpreter(build_tree(filename), require_main=False)
+    compiled = high_level_file_interpreter.compile()
+    global_store = high_level_file_interpreter.global_store
+    optimisations = [name for name in optimisations or [] if name in LowLevelFileInterpreter.compile_optimisations]
+    low_level_file_interpreter = LowLevelFileInterpreter(compiled, global_store, optimisations, relocatable=True)
+    calls = low_level_file_interpreter.call_graph.calls
+    own = [var for var in global_store if not var.offset.symbol]
+    exports = {sub: [param.offset.plus for param in global_store.get_ordered_params(sub)] for sub in calls}
+    imports = set().union(*calls.values()) - calls.keys()
+    return ObjectModule(filename,
+                        low_level_file_interpreter.compiled,
+                        max((var.offset.plus + var.size for var in own), default=0),
+                        exports,
+                        imports,
+                        {var.name: var.offset.plus for var in own})
+
+
+def compile_modules(filenames: list, optimisations=None, workers=None) -> list:
+    """
+    Compile each file in its own process
+
+    :param filenames:
+    :param optimisations:
+    :param workers: number of processes, None for one per CPU
+    :return: an ObjectModule for each file, in the same order
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(compile_module, filenames, [optimisations] * len(filenames)))
+
+
+class Linker:
+    def __init__(self, modules: list, optimisations=None):
+        """
+        Link modules into a program
+
+        :param modules: ObjectModules, one of which has the main
+        :param optimisations: the peephole passes to run on the program, others are ignored
+        """
+        mains = [module for module in modules if "main" in module.exports]
+        if len(mains) != 1:
+            raise SyntaxError("Expected one module with a main, got {}".format(len(mains)))
+        self.modules = mains + [module for module in modules if module is not mains[0]]
+        defined = {}
+        for module in self.modules:
+            for sub in module.exports:
+                if sub in defined:
+                    raise SyntaxError("Sub `{}` defined in both {} and {}".format(sub, defined[sub].filename,
+                                                                                module.filename))
+                defined[sub] = module
+        for module in self.modules:
+            for sub in sorted(module.imports):
+                if sub not in defined:
+                    raise SyntaxError("Undefined sub `{}` called in {}".format(sub, module.filename))
+        # Address 0, then the variables of each module, then the result register and stack pointer
+        self.bases = []
+        base = 1
+        for module in self.modules:
+            self.bases.append(base)
+            base += module.size
+        self.symbols = {"<result>": base, "<stack>": base + 1}
+        for module, base in zip(self.modules, self.bases):
+            for sub, params in module.exports.items():
+                for i, plus in enumerate(params):
+                    self.symbols["{}.{}".format(sub, i)] = base + plus
+        stack = self.symbols["<stack>"]
+        compiled = ["MLZ -1 {} {}".format(stack + 1, stack)]
+        for index in range(len(self.modules)):
+            compiled.extend(self.relocate(index))
+        self.optimiser = None
+        passes = [name for name in optimisations or [] if name in PeepholeOptimiser.all_passes]
+        if passes:
+            self.optimiser = PeepholeOptimiser(stack, passes)
+            compiled = self.optimiser.optimise(compiled)
+        self.compiled = LowLevelFileInterpreter.add_jumps(compiled)
+
+    def relocate(self, index: int) -> list:
+        """
+        A module's code with its addresses filled in and its own labels renamed
+
+        :param index: position of the module in self.modules
+        :return:
+        """
+        module = self.modules[index]
+        base = self.bases[index]
+        shared = {"Start " + sub for sub in module.exports.keys() | module.imports}
+
+        def address(match):
+            symbol = match.group(1)
+            return str((self.symbols[symbol] if symbol else base) + int(match.group(2)))
+
+        def label(name):
+            return name if name in shared else "{}:{}".format(index, name)
+
+        rtn = []
+        for instruction in module.code:
+            if instruction.startswith("#"):
+                rtn.append("#" + label(instruction[1:]))
+                continue
+            instruction, semi, jump = address_pattern.sub(address, instruction).partition(";")
+            if semi:
+                instruction = "{}; {}".format(instruction, label(jump.strip()))
+            rtn.append(instruction)
+        return rtn
+
+    def address(self, module: ObjectModule, name: str) -> int:
+        """
+        The address a module's variable was linked at
+
+        :param module:
+        :param name:
+        :return:
+        """
+        return self.bases[self.modules.index(module)] + module.variables[name]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "-c":
+        for filename, module in zip(args[1:], compile_modules(args[1:])):
+            module.save(os.path.splitext(filename)[0] + ".qobj")
+    else:
+        sources = [filename for filename in args if not filename.endswith(".qobj")]
+        compiled = dict(zip(sources, compile_modules(sources)))
+        modules = [compiled.get(filename) or ObjectModule.load(filename) for filename in args]
+        print("\n".join(Linker(modules).compiled))
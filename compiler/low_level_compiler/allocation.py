@@ -0,0 +1,135 @@
+"""
+Give variables that are never live at the same time the same RAM address
+
+VariableStore.finalise gives every variable its own address. This builds an
+interference graph instead: two variables interfere if one is written while
+the other is live, and variables are coloured greedily so that neighbours
+never share an address.
+
+Liveness is worked out within each subroutine, so a variable live across a
+call also interferes with everything the call could write: the parameters
+and anything written by the subroutines it can reach. The parameters are set
+one at a time as the arguments are read, so they interfere with the
+arguments and each other too.
+
+Variables that keep their own address:
+- arrays and variables whose address is taken, which pointers can reach
+- global variables, the stack pointer and the result register
+- variables read before they're written in a subroutine, other than its
+  parameters, as they rely on RAM starting at 0
+"""
+from high_level_compiler.variables import Variable, ScratchVariable, VariableStore
+from low_level_compiler.liveness import LiveVariables, accesses
+from low_level_compiler.calls import CallGraph
+
+
+class RamAllocator:
+    def __init__(self, instruction_list: list, global_store: VariableStore, opcodes: list):
+        """
+        Work out the interference graph
+
+        :param instruction_list: output of the high level compiler
+        :param global_store:
+        :param opcodes: names of calls that are single instructions rather than subroutines
+        """
+        self.instructions = instruction_list
+        self.global_store = global_store
+        self.opcodes = opcodes
+        self.liveness = LiveVariables(instruction_list, global_store, opcodes)
+        self.call_graph = CallGraph(instruction_list, opcodes)
+        self.variables = [var for var in global_store if self.can_allocate(var)]
+        allocatable = set(self.variables)
+        self.interference = {var: set() for var in self.variables}
+        for i, instruction in enumerate(instruction_list):
+            if instruction[:2] == ("sub", "start"):
+                # Set together by every caller, including ones in other modules
+                params = set(global_store.get_ordered_params(instruction[2]))
+                self.interfere(params, params)
+            for var in self.written(instruction):
+                live = self.liveness.live_out[i] - {var}
+                if instruction[0] == "assign" and isinstance(instruction[2], Variable):
+                    # Both hold the same value afterwards
+                    live.discard(instruction[2])
+                self.interfere({var}, live)
+            if instruction[0] == "call_sub" and instruction[1] not in opcodes:
+                params = set(global_store.get_ordered_params(instruction[1]))
+                clobbered = self.clobbers(instruction[1])
+                self.interfere(self.liveness.after_call(i), (allocatable if clobbered is None else clobbered) | params)
+                self.interfere(params, accesses(instruction)[0] | params)
+        # Number of addresses used by variables, before and after allocating
+        self.before = global_store["<stack>"].offset - 1
+        self.after = None
+
+    def can_allocate(self, var) -> bool:
+        if var.is_array or var.name in ("<stack>", "<result>") or var in self.liveness.always_live:
+            return False
+        if var.is_global and not isinstance(var, ScratchVariable):
+            return False
+        for i, instruction in enumerate(self.instructions):
+            if instruction[:2] == ("sub", "start") and var in self.liveness.live_in[i]:
+                if var not in self.global_store.get_ordered_params(instruction[2]):
+                    return False
+        return True
+
+    def written(self, instruction: tuple) -> set:
+        """
+        The allocated variables an instruction might write
+        """
+        if instruction[0] == "assign":
+            variable = instruction[1]
+        elif instruction[0] == "call_sub":
+            variable = instruction[3]
+        else:
+            return set()
+        return {variable} & self.interference.keys()
+
+    def clobbers(self, sub_name: str):
+        """
+        Everything a call could write, None if it could be anything
+
+        :param sub_name:
+        :return:
+        """
+        rtn = set()
+        seen = set()
+        todo = [sub_name]
+        while todo:
+            sub = todo.pop()
+            if sub in seen:
+                continue
+            seen.add(sub)
+            if self.call_graph.writes.get(sub) is None:
+                return None
+            rtn |= self.call_graph.writes[sub]
+            for called in self.call_graph.calls[sub]:
+                rtn |= set(self.global_store.get_ordered_params(called))
+                todo.append(called)
+        return rtn
+
+    def interfere(self, variables: set, others: set):
+        for var in variables:
+            for other in others:
+                if var is not other and var in self.interference and other in self.interference:
+                    self.interference[var].add(other)
+                    self.interference[other].add(var)
+
+    def allocate(self):
+        """
+        Set the offset of every variable, keeping the stack pointer last
+
+        :return:
+        """
+        colours = {}
+        for var in self.variables:
+            used = set(colours[other] for other in self.interference[var] if other in colours)
+            colours[var] = min(set(range(len(used) + 1)) - used)
+        offset = 1
+        for var in self.global_store:
+            if var not in colours and var.name != "<stack>":
+                var.set_offset(offset)
+                offset += var.size
+        for var, colour in colours.items():
+            var.set_offset(offset + colour)
+        offset += max(colours.values(), default=-1) + 1
+        self.global_store["<stack>"].set_offset(offset)
+        self.after = offset - 1
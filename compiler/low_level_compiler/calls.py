@@ -0,0 +1,60 @@
+"""
+Which subroutines each subroutine calls, and which variables it writes
+
+A leaf subroutine calls nothing else, so the only variables a call to it can
+change are the ones it writes itself. The caller doesn't need to save any of
+its other variables around the call.
+"""
+from typing import Optional
+
+from high_level_compiler.variables import Variable
+
+
+class CallGraph:
+    def __init__(self, instruction_list: list, opcodes: list):
+        """
+        Find the calls and writes in each subroutine
+
+        :param instruction_list: output of the high level compiler
+        :param opcodes: names of calls that are single instructions rather than subroutines
+        """
+        # Subroutine: names of the subroutines it calls
+        self.calls = {}
+        # Subroutine: variables it writes, None if it writes through a pointer
+        self.writes = {}
+        sub = None
+        for instruction in instruction_list:
+            kind = instruction[0]
+            if kind == "sub":
+                sub = instruction[2]
+                self.calls.setdefault(sub, set())
+                self.writes.setdefault(sub, set())
+                continue
+            if kind == "call_sub" and instruction[1] not in opcodes:
+                self.calls[sub].add(instruction[1])
+            if kind not in ("assign", "call_sub") or self.writes[sub] is None:
+                continue
+            variable = instruction[1] if kind == "assign" else instruction[3]
+            if not isinstance(variable, Variable):
+                continue
+            if not variable.is_pointer:
+                self.writes[sub].add(variable)
+            elif variable.points_to.is_array:
+                # An element of an array at a fixed index
+                self.writes[sub].add(variable.points_to)
+            else:
+                self.writes[sub] = None
+
+    def is_leaf(self, sub_name: str) -> bool:
+        return not self.calls.get(sub_name, True)
+
+    def clobbers(self, sub_name: str) -> Optional[set]:
+        """
+        The variables a call to `sub_name` can change, None if it could be any
+
+        :param sub_name:
+        :return:
+        """
+        if not self.is_leaf(sub_name):
+            return None
+        return self.writes[sub_name]
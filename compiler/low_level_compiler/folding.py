@@ -0,0 +1,258 @@
+"""
+Constant folding and propagation over the high level compiler's output
+
+Operators are inlined down to calls of single opcodes, so folding works on
+those rather than on the operators themselves. The opcodes always mean the
+same thing, however stdint defines the operators.
+
+Through straight line code this tracks the variables holding a known value,
+replaces reads of them with the value, and turns opcodes of known values into
+assignments. Conditional moves with a known condition become an assignment
+or nothing, and an if or while whose condition is known to skip it is
+removed. Assignments that are never read are then removed.
+"""
+from high_level_compiler.variables import Variable, VariableStore
+from low_level_compiler.liveness import LiveVariables, references
+
+# The interpreter's word size, which the compiler doesn't import the interpreter for
+max_value = (1 << 16) - 1
+negative_bit = 1 << 15
+
+# Value of each opcode, matching interpreter.OPERATIONS, which TestBuild.test_fold_operations checks
+OPERATIONS = {"__ADD__": lambda a, b: a + b,
+              "__SUB__": lambda a, b: a - b,
+              "__AND__": lambda a, b: a & b,
+              "__OR__": lambda a, b: a | b,
+              "__XOR__": lambda a, b: a ^ b,
+              "__ANT__": lambda a, b: a & ~b,
+              "__SL__": lambda a, b: a << b,
+              "__SRL__": lambda a, b: (a - max_value - 1 if a & negative_bit else a) >> b,
+              "__SRA__": lambda a, b: a >> b,
+              }
+# Whether each conditional move writes
+CONDITIONS = {"__MNZ__": lambda a: a != 0,
+              "__MLZ__": lambda a: bool(a & negative_bit),
+              }
+
+
+def merge(known: dict, other: dict) -> dict:
+    """
+    The values known on both of two paths
+    """
+    return {var: value for var, value in known.items() if var in other and other[var] == value}
+
+
+class ConstantFolder:
+    def __init__(self, global_store: VariableStore, opcodes: list):
+        """
+        :param global_store:
+        :param opcodes: names of calls that are single instructions rather than subroutines
+        """
+        self.global_store = global_store
+        self.opcodes = opcodes
+        # Number of high level instructions folded into an assignment or removed
+        self.folded = 0
+
+    def fold(self, instruction_list: list) -> list:
+        """
+        Fold and remove dead assignments until nothing changes
+
+        :param instruction_list: output of the high level compiler
+        :return:
+        """
+        while 1:
+            before = instruction_list
+            instruction_list = self.remove_dead(self.propagate(instruction_list))
+            if instruction_list == before:
+                return instruction_list
+
+    def propagate(self, instruction_list: list) -> list:
+        """
+        Replace reads of variables with a known value, and fold opcodes
+
+        :param instruction_list:
+        :return:
+        """
+        # Variables whose address is taken could change without being named
+        self.referenced = set().union(*map(references, instruction_list))
+        loops = self.loop_writes(instruction_list)
+        conditions = {instruction[2]: instruction[3] for instruction in instruction_list
+                      if instruction[0] == "while" and instruction[1] == "end"}
+        rtn = []
+        known = {}
+        # Values known at the start of each if and while, to merge with the end of it
+        starts = {}
+        # Ifs whose body always runs
+        removed = set()
+        skip = None
+        for instruction in instruction_list:
+            kind = instruction[0]
+            if skip is not None:
+                # Inside a removed if or while
+                if kind == skip[0] and instruction[1] == "end" and instruction[2] == skip[1]:
+                    skip = None
+                continue
+            if kind == "sub":
+                known = {}
+            elif kind == "assign":
+                variable, value = instruction[1:]
+                value = self.value(value, known)
+                instruction = (kind, variable, value)
+                self.write(known, variable, value)
+            elif kind == "call_sub" and instruction[1] in self.opcodes:
+                instruction = self.fold_opcode(instruction, known)
+                if instruction is None:
+                    self.folded += 1
+                    continue
+            elif kind == "call_sub":
+                sub_name, args, result = instruction[1:]
+                instruction = (kind, sub_name, [self.value(arg, known) for arg in args], result)
+                # The subroutine could change anything
+                known = {}
+            elif kind == "return":
+                instruction = (kind, self.value(instruction[1], known))
+            elif kind == "if" and instruction[1] == "start":
+                condition = self.value(instruction[3], known)
+                if isinstance(condition, int):
+                    self.folded += 1
+                    if condition:
+                        # The jump past the body is always taken
+                        skip = kind, instruction[2]
+                    else:
+                        removed.add(instruction[2])
+                    continue
+                instruction = instruction[:3] + (condition,)
+                starts[kind, instruction[2]] = dict(known)
+            elif kind == "if":
+                if instruction[2] in removed:
+                    continue
+                known = merge(known, starts.pop((kind, instruction[2])))
+            elif kind == "while" and instruction[1] == "start":
+                if self.value(conditions[instruction[2]], known) == 0:
+                    # The condition is checked first, and the loop never runs
+                    skip = kind, instruction[2]
+                    self.folded += 1
+                    continue
+                writes = loops[instruction[2]]
+                if writes is None:
+                    known = {}
+                else:
+                    known = {var: value for var, value in known.items() if var not in writes}
+                starts[kind, instruction[2]] = dict(known)
+            elif kind == "while":
+                # The condition is also checked straight from the start
+                known = merge(known, starts.pop((kind, instruction[2])))
+                instruction = instruction[:3] + (self.value(instruction[3], known),)
+            rtn.append(instruction)
+        return rtn
+
+    def fold_opcode(self, instruction: tuple, known: dict):
+        """
+        Fold a call to an opcode, None if it never writes anything
+
+        :param instruction:
+        :param known:
+        :return:
+        """
+        kind, opcode, args, result = instruction
+        a, b = [self.value(arg, known) for arg in args]
+        instruction = (kind, opcode, [a, b], result)
+        if opcode in CONDITIONS and isinstance(a, int):
+            if not CONDITIONS[opcode](a):
+                return None
+            instruction = ("assign", result, b)
+            self.folded += 1
+        elif opcode in OPERATIONS and isinstance(a, int) and isinstance(b, int):
+            b = OPERATIONS[opcode](a, b) & max_value
+            instruction = ("assign", result, b)
+            self.folded += 1
+        else:
+            b = None
+        self.write(known, result, b)
+        return instruction
+
+    def value(self, value, known: dict):
+        """
+        The constant value of an operand if it is known, otherwise the operand
+
+        :param value:
+        :param known:
+        :return:
+        """
+        if isinstance(value, int):
+            return value & max_value
+        if isinstance(value, Variable) and value in known:
+            return known[value]
+        return value
+
+    def trackable(self, variable) -> bool:
+        return isinstance(variable, Variable) and not (variable.is_pointer or variable.is_reference or
+                                                       variable.is_array) and variable not in self.referenced
+
+    def write(self, known: dict, variable, value):
+        """
+        Record a write of `value` to `variable`, where a value of None isn't known
+
+        :param known:
+        :param variable:
+        :param value:
+        :return:
+        """
+        if self.trackable(variable):
+            if isinstance(value, int):
+                known[variable] = value
+            else:
+                known.pop(variable, None)
+        elif isinstance(variable, Variable) and variable.is_pointer:
+            # Could be a write to anything whose address is taken
+            for var in list(known):
+                if var in self.referenced:
+                    del known[var]
+
+    def loop_writes(self, instruction_list: list) -> dict:
+        """
+        The variables written inside each while loop, None if it calls a subroutine
+
+        :param instruction_list:
+        :return: while id: set of variables or None
+        """
+        rtn = {}
+        open_loops = []
+        for instruction in instruction_list:
+            kind = instruction[0]
+            if kind == "while" and instruction[1] == "start":
+                open_loops.append(instruction[2])
+                rtn[instruction[2]] = set()
+            elif kind == "while":
+                open_loops.remove(instruction[2])
+            elif kind in ("assign", "call_sub"):
+                variable = instruction[1] if kind == "assign" else instruction[3]
+                custom = kind == "call_sub" and instruction[1] not in self.opcodes
+                for loop in open_loops:
+                    if rtn[loop] is None:
+                        continue
+                    if custom or not self.trackable(variable) and isinstance(variable, Variable) \
+                            and variable.is_pointer:
+                        rtn[loop] = None
+                    else:
+                        rtn[loop].add(variable)
+        return rtn
+
+    def remove_dead(self, instruction_list: list) -> list:
+        """
+        Remove assignments and opcodes whose result is never read
+
+        :param instruction_list:
+        :return:
+        """
+        liveness = LiveVariables(instruction_list, self.global_store, self.opcodes)
+        rtn = []
+        for i, instruction in enumerate(instruction_list):
+            kind = instruction[0]
+            if kind == "assign" or (kind == "call_sub" and instruction[1] in self.opcodes):
+                variable = instruction[1] if kind == "assign" else instruction[3]
+                if self.trackable(variable) and variable not in liveness.live_out[i]:
+                    self.folded += 1
+                    continue
+            rtn.append(instruction)
+        return rtn
@@ -0,0 +1,159 @@
+"""
+Inline small subroutines at their call sites
+
+A subroutine can be inlined if it doesn't call itself, directly or through
+other subroutines, and its only return is its last statement. Its variables
+stay where they are in RAM, which is safe as it can't be running at the
+time. The body replaces the call. Parameters become the arguments, unless
+the body writes them, and the return becomes an assignment to the call's
+result.
+
+The call saves the caller's variables around the body, so the body can't
+write any that are still to be read.
+"""
+from high_level_compiler.variables import Variable, VariableStore
+from high_level_compiler.high_level_compiler import GlobalLocalStoreHelper, IfInterpreter, WhileInterpreter
+from low_level_compiler.liveness import LiveVariables
+from low_level_compiler.calls import CallGraph
+
+
+class Inliner:
+    # Most high level instructions in a subroutine to inline it
+    threshold = 24
+
+    def __init__(self, global_store: VariableStore, opcodes: list, threshold: int = None, keep_subs: bool = False):
+        """
+        :param global_store:
+        :param opcodes: names of calls that are single instructions rather than subroutines
+        :param threshold: overrides Inliner.threshold
+        :param keep_subs: keep subroutines that are no longer called, for when other modules can call them
+        """
+        self.global_store = global_store
+        self.opcodes = opcodes
+        self.keep_subs = keep_subs
+        if threshold is not None:
+            self.threshold = threshold
+        # Names of the subroutines inlined, and where: (subroutine, caller) for each call
+        self.inlined = []
+
+    def inline(self, instruction_list: list) -> list:
+        """
+        Inline calls until there are none left to inline, then remove subroutines no longer called
+
+        :param instruction_list: output of the high level compiler
+        :return:
+        """
+        while 1:
+            inlined = len(self.inlined)
+            instruction_list = self.inline_calls(instruction_list)
+            if len(self.inlined) == inlined:
+                break
+        call_graph = CallGraph(instruction_list, self.opcodes)
+        called = set().union(*call_graph.calls.values())
+        removed = set(sub for sub, caller in self.inlined) - called
+        if self.keep_subs:
+            removed = set()
+        rtn = []
+        sub = None
+        for instruction in instruction_list:
+            if instruction[0] == "sub" and instruction[1] == "start":
+                sub = instruction[2]
+            if sub not in removed:
+                rtn.append(instruction)
+        return rtn
+
+    def inline_calls(self, instruction_list: list) -> list:
+        """
+        Inline every call that can be in one pass
+
+        :param instruction_list:
+        :return:
+        """
+        bodies = {}
+        for i, instruction in enumerate(instruction_list):
+            if instruction[0] == "sub" and instruction[1] == "start":
+                start = i
+            elif instruction[0] == "sub":
+                bodies[instruction[2]] = instruction_list[start+1:i]
+        call_graph = CallGraph(instruction_list, self.opcodes)
+        liveness = LiveVariables(instruction_list, self.global_store, self.opcodes)
+        rtn = []
+        sub = None
+        for i, instruction in enumerate(instruction_list):
+            if instruction[0] == "sub":
+                sub = instruction[2]
+            if instruction[0] != "call_sub" or instruction[1] not in bodies or \
+                    not self.can_inline(instruction[1], bodies[instruction[1]], sub, call_graph,
+                                        liveness.after_call(i)):
+                rtn.append(instruction)
+                continue
+            sub_name, args, result = instruction[1:]
+            rtn.extend(self.substitute(sub_name, bodies[sub_name], args, result, call_graph.writes[sub_name]))
+            self.inlined.append((sub_name, sub))
+        return rtn
+
+    def can_inline(self, sub_name: str, body: list, caller: str, call_graph: CallGraph, live: set) -> bool:
+        """
+        Whether a call from `caller` to `sub_name` can be replaced by its body
+
+        :param sub_name:
+        :param body:
+        :param caller:
+        :param call_graph:
+        :param live: variables read after the call
+        :return:
+        """
+        if sub_name in ("main", caller) or len(body) > self.threshold:
+            return False
+        returns = [i for i, instruction in enumerate(body) if instruction[0] == "return"]
+        if returns not in ([], [len(body) - 1]):
+            return False
+        writes = call_graph.writes[sub_name]
+        if writes is None or writes & live & set(self.global_store.filter_subroutine(caller)):
+            return False
+        # Recursive, if it can get back to itself
+        seen = set()
+        todo = list(call_graph.calls[sub_name])
+        while todo:
+            called = todo.pop()
+            if called == sub_name:
+                return False
+            if called not in seen:
+                seen.add(called)
+                todo.extend(call_graph.calls.get(called, ()))
+        return True
+
+    def substitute(self, sub_name: str, body: list, args: list, result: Variable, writes: set) -> list:
+        """
+        A copy of a subroutine's body, for one call to it
+
+        :param sub_name:
+        :param body:
+        :param args:
+        :param result:
+        :param writes: the variables the body writes
+        :return:
+        """
+        rtn = []
+        find = []
+        replace = []
+        for arg, param in zip(args, self.global_store.get_ordered_params(sub_name)):
+            if isinstance(arg, Variable) and not (arg.is_pointer or arg.is_reference or arg.is_array) and \
+                    param not in writes and arg not in writes:
+                find.append(param)
+                replace.append(arg)
+            else:
+                rtn.append(("assign", param, arg))
+        helper = GlobalLocalStoreHelper(self.global_store, None, None)
+        # Each copy needs its own labels
+        ids = {}
+        for instruction in helper.replace_variables(body, find, replace):
+            if instruction[0] in ("if", "while"):
+                key = instruction[0], instruction[2]
+                if key not in ids:
+                    ids[key] = next((IfInterpreter if key[0] == "if" else WhileInterpreter).id_gen)
+                instruction = instruction[:2] + (ids[key],) + instruction[3:]
+            elif instruction[0] == "return":
+                instruction = ("assign", result, instruction[1])
+            rtn.append(instruction)
+        return rtn
@@ -0,0 +1,173 @@
+"""
+Live variable analysis of the high level compiler's output
+
+A variable is live at a point if some path from there reads it before it is
+written. A call to a subroutine only needs to save and restore the caller's
+variables that are live once it returns, as the others are written before
+anything reads them again.
+
+Arrays and variables whose address is taken could be read through a
+pointer anywhere, so are always live. Global variables are live wherever a
+subroutine returns or calls another, which could read them, and main's
+variables are live at the end of main as they're the program's output.
+"""
+from high_level_compiler.variables import Variable, ScratchVariable, VariableStore
+from high_level_compiler.high_level_compiler import ArrayInterpreter
+
+
+class LiveVariables:
+    def __init__(self, instruction_list: list, global_store: VariableStore, opcodes: list):
+        """
+        Find the variables live after each high level instruction
+
+        :param instruction_list: output of the high level compiler
+        :param global_store:
+        :param opcodes: names of calls that are single instructions rather than subroutines
+        """
+        self.instructions = instruction_list
+        self.opcodes = opcodes
+        self.always_live = set(var for var in global_store if var.is_array)
+        for instruction in instruction_list:
+            self.always_live.update(references(instruction))
+        self.globals = set(var for var in global_store
+                           if var.is_global and not isinstance(var, ScratchVariable) and not var.is_array)
+        self.main = set(var for var in global_store if getattr(var, "sub", None) == "main")
+        self.successors = self.link()
+        self.live_out = [set() for instruction in instruction_list]
+        self.solve()
+
+    def link(self) -> list:
+        """
+        Index of the instructions that can run after each instruction
+
+        :return:
+        """
+        starts = {}
+        ends = {}
+        for i, instruction in enumerate(self.instructions):
+            if instruction[0] in ("if", "while"):
+                (starts if instruction[1] == "start" else ends)[instruction[0], instruction[2]] = i
+        successors = []
+        # The subroutine each instruction is in
+        self.subs = []
+        for i, instruction in enumerate(self.instructions):
+            kind = instruction[0]
+            if kind == "sub":
+                sub = instruction[2]
+            self.subs.append(sub)
+            if kind == "return" or (kind == "sub" and instruction[1] == "end"):
+                successors.append([])
+            elif kind == "while" and instruction[1] == "start":
+                # Check the condition first
+                successors.append([ends[kind, instruction[2]]])
+            elif kind == "while":
+                successors.append([i + 1, starts[kind, instruction[2]] + 1])
+            elif kind == "if" and instruction[1] == "start":
+                successors.append([i + 1, ends[kind, instruction[2]]])
+            else:
+                successors.append([i + 1])
+        return successors
+
+    def solve(self):
+        """
+        Propagate reads backwards until nothing changes
+
+        :return:
+        """
+        self.live_in = live_in = [set() for instruction in self.instructions]
+        changed = True
+        while changed:
+            changed = False
+            for i in reversed(range(len(self.instructions))):
+                live_out = set(self.always_live)
+                for successor in self.successors[i]:
+                    live_out |= live_in[successor]
+                if not self.successors[i]:
+                    live_out |= self.globals
+                    if self.subs[i] == "main":
+                        live_out |= self.main
+                reads, writes = accesses(self.instructions[i])
+                if self.instructions[i][0] == "call_sub" and self.instructions[i][1] not in self.opcodes:
+                    reads = reads | self.globals
+                new_in = (live_out - writes) | reads
+                if new_in != live_in[i]:
+                    live_in[i] = new_in
+                    changed = True
+                self.live_out[i] = live_out
+
+    def after_call(self, i: int) -> set:
+        """
+        The variables read after the subroutine called by instruction i returns
+
+        The result is written after the caller's variables are restored, so it
+        doesn't need restoring itself.
+
+        :param i:
+        :return:
+        """
+        return self.live_out[i] - accesses(self.instructions[i])[1]
+
+
+def reads(value) -> set:
+    """
+    The variables read by an operand
+
+    :param value:
+    :return:
+    """
+    if isinstance(value, Variable):
+        if value.is_reference:
+            return set()
+        # A pointer reads the variable holding the address, or the array it indexes
+        return {value.points_to}
+    if isinstance(value, ArrayInterpreter):
+        value = value.val
+    if isinstance(value, list):
+        return set().union(*map(reads, value))
+    return set()
+
+
+def references(instruction: tuple) -> set:
+    """
+    The variables an instruction takes the address of
+
+    :param instruction:
+    :return:
+    """
+    rtn = set()
+    for operand in instruction[1:]:
+        for value in (operand if isinstance(operand, list) else [operand]):
+            if isinstance(value, Variable) and value.is_reference:
+                rtn.add(value.points_to)
+    return rtn
+
+
+def accesses(instruction: tuple) -> tuple:
+    """
+    The variables an instruction reads, and the ones it always overwrites
+
+    :param instruction:
+    :return: reads, writes
+    """
+    kind = instruction[0]
+    if kind == "assign":
+        variable, value = instruction[1:]
+        rtn = reads(value)
+    elif kind == "call_sub":
+        sub_name, args, variable = instruction[1:]
+        rtn = reads(args)
+        if sub_name in ("__MNZ__", "__MLZ__"):
+            # Conditional moves might leave the old value
+            return rtn | reads(variable) - {variable}, set()
+    elif kind == "return":
+        return reads(instruction[1]), set()
+    elif kind in ("if", "while"):
+        return reads(instruction[3]), set()
+    else:
+        return set(), set()
+    if not isinstance(variable, Variable):
+        return rtn, set()
+    if variable.is_pointer:
+        # Writing through a pointer reads the address and might not write all of the variable
+        return rtn | {variable.points_to}, set()
+    return rtn, {variable}
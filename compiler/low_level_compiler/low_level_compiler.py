@@ -1,19 +1,53 @@
 from typing import List, Optional
 
-from high_level_compiler.variables import VariableStore, Variable, id_gen
+from high_level_compiler.variables import VariableStore, Variable, CustomVariable, id_gen
 from high_level_compiler.high_level_compiler import ArrayInterpreter
+from low_level_compiler.peephole import PeepholeOptimiser
+from low_level_compiler.liveness import LiveVariables, reads
+from low_level_compiler.calls import CallGraph
+from low_level_compiler.inliner import Inliner
+from low_level_compiler.folding import ConstantFolder
+from low_level_compiler.allocation import RamAllocator
+
+
+class Address:
+    def __init__(self, symbol: str = "", plus: int = 0):
+        """
+        A RAM address for the linker to fill in
+
+        :param symbol: "" for the start of the module's variables, otherwise the name of an address shared
+            between modules
+        :param plus: words after it
+        """
+        self.symbol = symbol
+        self.plus = plus
+
+    def __add__(self, other: int) -> "Address":
+        return Address(self.symbol, self.plus + other)
+
+    __radd__ = __add__
+
+    def __str__(self):
+        return "@{}+{}".format(self.symbol, self.plus)
 
 
 class FileInterpreter:
     opcodes = ["__MNZ__", "__MLZ__", "__ADD__", "__SUB__", "__AND__",
                "__OR__", "__XOR__", "__ANT__", "__SL__", "__SRL__", "__SRA__"]
+    # Optimisations made while compiling, rather than by the PeepholeOptimiser afterwards
+    compile_optimisations = ["inline_subs", "fold_constants", "allocate_ram", "live_variables", "tail_calls",
+                             "leaf_calls"]
+    all_optimisations = compile_optimisations + PeepholeOptimiser.all_passes
 
-    def __init__(self, instruction_list, global_store: VariableStore):
+    def __init__(self, instruction_list, global_store: VariableStore, optimisations: Optional[List[str]] = None,
+                 relocatable: bool = False):
         """
         Compile a list of high level instructions into QFTASM code
 
         :param instruction_list:
         :param global_store:
+        :param optimisations: names from all_optimisations to use, None for none
+        :param relocatable: leave the addresses and labels for the linker, see linker.ObjectModule
         """
         self.compilers = {
             "sub": self.sub_compiler,
@@ -25,11 +59,41 @@ class FileInterpreter:
         }
         self.global_store = global_store
         self.current_sub = None
+        self.optimisations = optimisations = optimisations or []
+        self.relocatable = relocatable
+        self.inliner = None
+        if "inline_subs" in optimisations:
+            self.inliner = Inliner(global_store, self.opcodes, keep_subs=relocatable)
+            instruction_list = self.inliner.inline(instruction_list)
+        self.folder = None
+        if "fold_constants" in optimisations:
+            self.folder = ConstantFolder(global_store, self.opcodes)
+            instruction_list = self.folder.fold(instruction_list)
+        self.allocator = None
+        if "allocate_ram" in optimisations:
+            self.allocator = RamAllocator(instruction_list, global_store, self.opcodes)
+            self.allocator.allocate()
+        if relocatable:
+            self.relocate()
+        self.instruction_list = instruction_list
+        self.liveness = None
+        if "live_variables" in optimisations:
+            self.liveness = LiveVariables(instruction_list, global_store, self.opcodes)
+        self.call_graph = CallGraph(instruction_list, self.opcodes)
+        # Index of the instruction being compiled
+        self.index = None
+        # Whether the last call was a tail call, which does the following return itself
+        self.tail_call = False
+        # (subroutine called, calling subroutine, variables saved, variables that could be saved) for each call
+        self.call_saves = []
         # Set the current value of the stack to the end of the variables
         # This happens to be just after the stack word as it's inserted at the end
         compiled = ["MLZ -1 {} {}".format(self.global_store["<stack>"].offset+1,
                                           self.parse_result(self.global_store["<stack>"]))]
-        for instruction in instruction_list:
+        if relocatable:
+            # The linker sets the stack pointer once for every module
+            compiled = []
+        for self.index, instruction in enumerate(instruction_list):
             #print(instruction)
             # Check the output of the high level compiler can be compiled
             assert instruction[0] in self.compilers, "Cannot compile high level instruction {}".format(instruction)
@@ -37,6 +101,15 @@ class FileInterpreter:
             compiled.extend(self.compilers[instruction[0]](*instruction[1:]))
         #print("\n".join(compiled))
 
+        self.optimiser = None
+        if relocatable:
+            # The linker optimises and adds the jumps once the addresses are known
+            self.compiled = compiled
+            return
+        passes = [name for name in optimisations if name not in self.compile_optimisations]
+        if passes:
+            self.optimiser = PeepholeOptimiser(self.global_store["<stack>"].offset, passes)
+            compiled = self.optimiser.optimise(compiled)
         # Strip out the jump label information
         compiled = self.add_jumps(compiled)
         # Make the compiler work with the new version of QFTASM
@@ -80,11 +153,24 @@ class FileInterpreter:
         rtn = []
         # Get all local variables associated with the current subroutine
         variables = self.global_store.filter_subroutine(self.current_sub)
-        for var in variables:
+        if "tail_calls" in self.optimisations and self.is_tail_call(sub_name, args, result):
+            self.call_saves.append((sub_name, self.current_sub, 0, len(variables)))
+            return self.tail_call_compiler(sub_name, args)
+        saved = variables
+        if self.liveness is not None:
+            # The rest are written before they're next read
+            live = self.liveness.after_call(self.index)
+            saved = [var for var in variables if var in live]
+        if "leaf_calls" in self.optimisations:
+            clobbered = self.call_graph.clobbers(sub_name)
+            if clobbered is not None:
+                saved = [var for var in saved if var in clobbered]
+        self.call_saves.append((sub_name, self.current_sub, len(saved), len(variables)))
+        for var in saved:
             # Push each local to the stack
             rtn.extend(self.push_stack(self.parse_variable(var)))
         # Put all the arguments to the called subroutine into their place in RAM
-        for param, arg in zip(args, self.global_store.get_ordered_params(sub_name)):
+        for param, arg in zip(args, self.params(sub_name, len(args))):
             #print(param, arg.offset)
             rtn.append("MLZ -1 {} {}".format(self.parse_variable(param),
                                              self.parse_result(arg)))
@@ -97,13 +183,82 @@ class FileInterpreter:
         # Write the label to jump back to
         rtn.append("#EndCall {}_{}".format(sub_name, uuid))
         # Pop all the variables from the stack into their respective locations
-        for var in reversed(variables):
+        for var in reversed(saved):
             rtn.extend(self.pop_stack(self.parse_result(var)))
         # Copy the result from the result register to the destination
         rtn.append("MLZ -1 {} {}".format(self.parse_variable(self.global_store["<result>"]),
                                          self.parse_result(result)))
         return rtn
 
+    def is_tail_call(self, sub_name: str, args: list, result: Variable) -> bool:
+        """
+        Whether the call being compiled is immediately followed by returning its result
+
+        :param sub_name:
+        :param args:
+        :param result:
+        :return:
+        """
+        # main has no return address on the stack
+        if self.current_sub == "main" or self.index + 1 >= len(self.instruction_list):
+            return False
+        following = self.instruction_list[self.index + 1]
+        if following[0] != "return" or following[1] is not result or result.is_pointer:
+            return False
+        # Setting a parameter can't change an argument which is still to be read
+        params = self.params(sub_name, len(args))
+        for i, param in enumerate(params):
+            if any(param in reads(arg) for arg in args[i+1:]):
+                return False
+        return True
+
+    def tail_call_compiler(self, sub_name: str, args: List[Variable]):
+        """
+        Compile a call followed by returning its result as a jump
+
+        The caller's return address is left on the stack, so the called
+        subroutine returns straight to the caller's caller with the result.
+
+        :param sub_name:
+        :param args:
+        :return:
+        """
+        rtn = []
+        for param, arg in zip(args, self.params(sub_name, len(args))):
+            rtn.append("MLZ -1 {} {}".format(self.parse_variable(param),
+                                             self.parse_result(arg)))
+        rtn.append("MLZ -1 {} 0; Start {}".format("{}", sub_name))
+        rtn.append("MNZ 0 0 0")
+        self.tail_call = True
+        return rtn
+
+    def params(self, sub_name: str, count: int) -> List[Variable]:
+        """
+        The parameters of a subroutine, which the linker finds the addresses of if it's in another module
+
+        :param sub_name:
+        :param count: number of arguments it's called with
+        :return:
+        """
+        if self.relocatable and sub_name not in self.call_graph.calls:
+            params = [CustomVariable(name="{}.{}".format(sub_name, i)) for i in range(count)]
+            for param in params:
+                param.set_offset(Address(param.name))
+            return params
+        return self.global_store.get_ordered_params(sub_name)
+
+    def relocate(self):
+        """
+        Make every address relative to the start of the variables, apart from the ones every module shares
+
+        :return:
+        """
+        for variable in self.global_store:
+            if variable.name in ("<stack>", "<result>"):
+                variable.set_offset(Address(variable.name))
+            else:
+                variable.set_offset(Address(plus=variable.offset - 1))
+
     def return_compiler(self, result):
         """
         Compile a return jump from a subroutine
@@ -111,6 +266,10 @@ class FileInterpreter:
         :param result:
         :return:
         """
+        if self.tail_call:
+            # The tail call already returns
+            self.tail_call = False
+            return []
         # Copy the return result to the result register
         rtn = ["MLZ -1 {} {}".format(self.parse_variable(result),
                                      self.parse_result(self.global_store["<result>"]))]
@@ -202,40 +361,58 @@ class FileInterpreter:
                                      self.parse_result(self.global_store["<stack>"]))
                 ]
 
-    def add_jumps(self, compiled):
+    @staticmethod
+    def add_jumps(compiled):
         """
         Turn jumps with labels into absolute addresses
 
+        The first sweep finds the address of every label and the second fills
+        in the jumps, so this is linear in the length of the program.
+
         :param compiled:
         :return:
         """
-        for i, instruction in enumerate(compiled):
+        # Address of the instruction following each label
+        labels = {}
+        instructions = []
+        # Labels following each instruction, which are added back as comments
+        following = []
+        for instruction in compiled:
+            if instruction.startswith("#"):
+                label = instruction[1:]
+                if label in labels:
+                    raise SyntaxError("Duplicate label `{}`".format(label))
+                labels[label] = len(instructions)
+                following[len(following)-1].append(label)
+            else:
+                instructions.append(instruction)
+                following.append([])
+        for i, instruction in enumerate(instructions):
             instruction, semi, jump = instruction.partition(";")
             # If the instruction has a label attached to it
             if semi:
                 jump = jump.strip()
                 assert jump[0] not in "+-"
-                # Find the target to the label
-                jump_offset = compiled.index("#"+jump)
-                jump_offset -= len([inst for inst in compiled[:jump_offset] if inst.startswith("#")])
+                if jump not in labels:
+                    raise SyntaxError("Undefined label `{}`".format(jump))
                 # Replace the instruction with one with the jump target embedded
-                compiled[i] = instruction.format(jump_offset-1)
-        # compiled = [inst for inst in compiled if not inst.startswith("#")]
-        # Add labels back
-        temp = []
-        for inst in compiled:
-            if inst.startswith("#"):
-                temp[len(temp)-1] += [inst[1:]]
+                instruction = instruction.format(labels[jump]-1)
+            # Add line numbers and labels
+            if following[i]:
+                instructions[i] = "{}. {}; {}".format(i, instruction, following[i][0])
             else:
-                temp += [[inst]]
-        compiled = temp
-        # Add line numbers
-        for i, instruction in enumerate(compiled):
-            if len(instruction) == 1:
-                compiled[i] = "{}. {};".format(i, compiled[i][0])
-            else:
-                compiled[i] = "{}. {}; {}".format(i, compiled[i][0], compiled[i][1])
-        return compiled
+                instructions[i] = "{}. {};".format(i, instruction)
+        return instructions
+
+    def binary(self) -> bytes:
+        """
+        The compiled program in the binary format loaded by Interpreter.from_binary
+
+        :return:
+        """
+        # The interpreter is outside the compiler, so this needs the repository root on the path
+        from interpreter.interpreter import Interpreter
+        return Interpreter("\n".join(self.compiled)).to_binary()
 
     def parse_variable(self, variable: Variable) -> str:
         """
@@ -0,0 +1,347 @@
+"""
+Peephole optimisations for the low level compiler's output
+
+The passes work on the instruction list just before add_jumps, where jump
+targets are still "#label" entries. Removing an instruction never needs any
+addresses fixing, as add_jumps resolves the labels afterwards.
+
+The instruction after a jump (its delay slot) always runs, and then the
+program carries on after the jump target, so delay slots are never removed.
+"""
+from typing import List, Optional
+
+
+class PeepholeOptimiser:
+    all_passes = ["self_moves", "stack_values", "jumps_to_next", "nops", "fill_delay_slots"]
+    # How far back fill_delay_slots looks for an instruction to move
+    fill_distance = 8
+
+    def __init__(self, stack: int, passes: Optional[List[str]] = None):
+        """
+        Remove redundant instructions from the low level compiler's output
+
+        :param stack: address of the stack pointer
+        :param passes: names of the passes to run, all of them by default
+        """
+        self.stack = str(stack)
+        self.passes = [getattr(self, name) for name in (self.all_passes if passes is None else passes)]
+        self.removed = 0
+
+    def optimise(self, compiled: list) -> list:
+        """
+        Run the passes until none of them change anything
+
+        :param compiled: instructions and "#label" entries
+        :return:
+        """
+        length = len(compiled)
+        while 1:
+            before = compiled
+            for optimisation in self.passes:
+                compiled = optimisation(compiled)
+            if compiled == before:
+                break
+        self.removed += length - len(compiled)
+        return compiled
+
+    def self_moves(self, compiled: list) -> list:
+        """
+        Remove moves of a value to where it already is, eg. MLZ -1 A5 5
+
+        :param compiled:
+        :return:
+        """
+        slots = delay_slots(compiled)
+        rtn = []
+        for i, instruction in enumerate(compiled):
+            if i not in slots and not is_label(instruction):
+                opcode, operands, label = split(instruction)
+                if opcode in ("MNZ", "MLZ") and label is None and operands[2] != "0" and \
+                        operands[1] == dereference(operands[2]):
+                    continue
+            rtn.append(instruction)
+        return rtn
+
+    def stack_values(self, compiled: list) -> list:
+        """
+        Drop pushes of values still in their stack slot, and merge changes to the stack pointer
+
+        Through straight line code this tracks which variable each stack slot
+        matches, by its offset from the stack pointer. Popping the locals after
+        a call leaves them on the stack, so pushing them again for the next
+        call can mostly be skipped.
+
+        :param compiled:
+        :return:
+        """
+        stack = self.stack
+        slots = delay_slots(compiled)
+        rtn = []
+        offset = 0
+        # Offset of a slot: the address holding the same value
+        known = {}
+        # Whether the last instruction kept moved the stack pointer and can be merged into
+        mergeable = False
+        for i, instruction in enumerate(compiled):
+            if is_label(instruction) or i in slots:
+                offset, known, mergeable = 0, {}, False
+                rtn.append(instruction)
+                continue
+            opcode, operands, label = split(instruction)
+            step = stack_step(opcode, operands, stack) if label is None else None
+            if step is not None:
+                offset += step
+                if mergeable:
+                    step += stack_step(*split(rtn.pop())[:2], stack)
+                if step:
+                    rtn.append("{} A{} {} {}".format("ADD" if step > 0 else "SUB", stack, abs(step), stack))
+                mergeable = bool(step)
+                continue
+            value, dest = operands[1:]
+            if opcode == "MLZ" and operands[0] == "-1" and label is None:
+                if value == "B" + stack and is_literal(dest) and dest != stack:
+                    # Popping a value
+                    known = {k: v for k, v in known.items() if v != dest}
+                    known[offset] = dest
+                    rtn.append(instruction)
+                    mergeable = False
+                    continue
+                if dest == "A" + stack and is_variable(value, stack) and not is_literal(value):
+                    # Pushing a value
+                    if known.get(offset) == value[1:]:
+                        continue
+                    known[offset] = value[1:]
+                    rtn.append(instruction)
+                    mergeable = False
+                    continue
+            if dest == "A" + stack:
+                known.pop(offset, None)
+            elif not is_literal(dest) or dest in (stack, "0"):
+                # Could write anywhere, or moves the stack pointer by an unknown amount
+                offset, known = 0, {}
+            else:
+                known = {k: v for k, v in known.items() if v != dest}
+            rtn.append(instruction)
+            mergeable = False
+        return rtn
+
+    def jumps_to_next(self, compiled: list) -> list:
+        """
+        Remove jumps to just after their own delay slot, which go to the same place either way
+
+        :param compiled:
+        :return:
+        """
+        slots = delay_slots(compiled)
+        removed = set()
+        for i, instruction in enumerate(compiled):
+            if i in slots or is_label(instruction):
+                continue
+            opcode, operands, label = split(instruction)
+            if not is_jump(opcode, operands) or label is None or operands[1] != "{}":
+                continue
+            slot = next_instruction(compiled, i)
+            if slot is None or is_jump(*split(compiled[slot])[:2]):
+                continue
+            j = slot + 1
+            while j < len(compiled) and is_label(compiled[j]):
+                if compiled[j] == "#" + label:
+                    removed.add(i)
+                    break
+                j += 1
+        return [instruction for i, instruction in enumerate(compiled) if i not in removed]
+
+    def nops(self, compiled: list) -> list:
+        """
+        Remove instructions that never write anything, unless they fill a delay slot
+
+        :param compiled:
+        :return:
+        """
+        slots = delay_slots(compiled)
+        return [instruction for i, instruction in enumerate(compiled)
+                if i in slots or is_label(instruction) or not is_nop(*split(instruction)[:2])]
+
+    def fill_delay_slots(self, compiled: list) -> list:
+        """
+        Move an earlier instruction into a jump's delay slot in place of a no-op
+
+        The instruction is taken from the same straight line of code as the
+        jump, and must not depend on, or be depended on by, anything it is
+        moved past. As it now runs after the jump, it must not read the PC.
+
+        :param compiled:
+        :return:
+        """
+        stack = self.stack
+        slots = delay_slots(compiled)
+        compiled = list(compiled)
+        for i, instruction in enumerate(compiled):
+            if i in slots or is_label(instruction) or not is_jump(*split(instruction)[:2]):
+                continue
+            if i+1 >= len(compiled) or is_label(compiled[i+1]) or not is_nop(*split(compiled[i+1])[:2]):
+                continue
+            moved_past = [accesses(compiled[i], stack)]
+            for j in range(i-1, max(i-1-self.fill_distance, -1), -1):
+                if j in slots or is_label(compiled[j]) or is_jump(*split(compiled[j])[:2]):
+                    break
+                reads, writes = accesses(compiled[j], stack)
+                if reads is not None and writes is not None and "0" not in reads and \
+                        not is_nop(*split(compiled[j])[:2]) and \
+                        all(independent(reads, writes, other_reads, other_writes)
+                            for other_reads, other_writes in moved_past):
+                    compiled[i+1] = compiled[j]
+                    compiled[j] = None
+                    break
+                moved_past.append((reads, writes))
+        return [instruction for instruction in compiled if instruction is not None]
+
+
+def split(instruction: str) -> tuple:
+    """
+    Split an instruction into its opcode, operands and jump label
+
+    :param instruction:
+    :return: opcode, list of operands, label or None
+    """
+    code, semicolon, label = instruction.partition(";")
+    opcode, *operands = code.split()
+    return opcode, operands, label.strip() if semicolon else None
+
+
+def is_label(instruction: str) -> bool:
+    return instruction.startswith("#")
+
+
+def is_literal(operand: str) -> bool:
+    return operand[0] not in "ABC{"
+
+
+def is_variable(operand: str, stack: str) -> bool:
+    """
+    Whether an operand is a literal or a plain read of an address other than the stack pointer
+    """
+    return is_literal(operand) or (operand[0] == "A" and is_literal(operand[1:]) and operand[1:] != stack)
+
+
+def dereference(operand: str) -> Optional[str]:
+    """
+    The operand reading the value at the address written by `operand` as a destination
+    """
+    if is_literal(operand):
+        return "A" + operand
+    if operand[0] in "AB":
+        return "BC"["AB".index(operand[0])] + operand[1:]
+    return None
+
+
+def stack_step(opcode: str, operands: list, stack: str) -> Optional[int]:
+    """
+    How far the instruction moves the stack pointer, None if it is not a literal step
+
+    :param opcode:
+    :param operands:
+    :param stack: address of the stack pointer
+    :return:
+    """
+    if opcode not in ("ADD", "SUB") or operands[0] != "A" + stack or operands[2] != stack or \
+            not is_literal(operands[1]):
+        return None
+    step = int(operands[1])
+    return step if opcode == "ADD" else -step
+
+
+def operand_reads(operand: str, stack: str, dest: bool = False) -> Optional[set]:
+    """
+    Addresses an operand reads, None if they depend on RAM other than the stack
+
+    Stack slots are all represented by "slot", as they never overlap variables.
+    """
+    if is_literal(operand) or operand == "{}":
+        return set()
+    layers = "ABC".index(operand[0]) + 1 - dest
+    address = operand[1:]
+    if layers == 0:
+        return set()
+    if layers == 1:
+        return {address}
+    if layers == 2 and address == stack:
+        return {address, "slot"}
+    return None
+
+
+def accesses(instruction: str, stack: str) -> tuple:
+    """
+    Addresses an instruction reads and writes, either can be None if not known
+
+    :param instruction:
+    :param stack: address of the stack pointer
+    :return: reads, writes
+    """
+    opcode, operands, label = split(instruction)
+    reads = set()
+    for operand in operands[:2]:
+        operand = operand_reads(operand, stack)
+        reads = None if reads is None or operand is None else reads | operand
+    dest = operands[2]
+    dest_reads = operand_reads(dest, stack, True)
+    if reads is not None and dest_reads is not None:
+        reads |= dest_reads
+    else:
+        reads = None
+    if is_literal(dest):
+        writes = {dest}
+    elif dest == "A" + stack:
+        writes = {"slot"}
+    else:
+        writes = None
+    return reads, writes
+
+
+def independent(reads: Optional[set], writes: Optional[set], other_reads: Optional[set],
+                other_writes: Optional[set]) -> bool:
+    """
+    Whether two instructions can run in either order
+    """
+    if None in (reads, writes, other_reads, other_writes):
+        return False
+    return not (writes & other_reads or writes & other_writes or reads & other_writes)
+
+
+def is_nop(opcode: str, operands: list) -> bool:
+    """
+    Whether the instruction never writes anything, such as MNZ 0 0 0
+    """
+    if opcode not in ("MNZ", "MLZ") or not is_literal(operands[0]):
+        return False
+    test = int(operands[0])
+    if opcode == "MNZ":
+        return test == 0
+    return 0 <= test < 1 << 15
+
+
+def is_jump(opcode: str, operands: list) -> bool:
+    return operands[2] == "0" and not is_nop(opcode, operands)
+
+
+def next_instruction(compiled: list, i: int) -> Optional[int]:
+    for j in range(i + 1, len(compiled)):
+        if not is_label(compiled[j]):
+            return j
+    return None
+
+
+def delay_slots(compiled: list) -> set:
+    """
+    Index of every instruction straight after a jump
+
+    :param compiled:
+    :return:
+    """
+    slots = set()
+    for i, instruction in enumerate(compiled):
+        if not is_label(instruction) and is_jump(*split(instruction)[:2]):
+            slot = next_instruction(compiled, i)
+            if slot is not None:
+                slots.add(slot)
+    return slots
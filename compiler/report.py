@@ -0,0 +1,74 @@
+"""
+Report the instructions, cycles and peak RAM the optimisations save
+
+    python report.py tests/*.txt
+    python report.py --passes self_moves,nops tests/*.txt
+
+Then for each call to a subroutine, how many variables are still saved and
+restored around it, out of the ones that would be without live_variables,
+tail_calls and leaf_calls, and which calls inline_subs inlined.
+"""
+import sys
+sys.path.insert(1, "..")
+
+from compiler import Compiler
+from interpreter.interpreter import Interpreter
+from low_level_compiler.low_level_compiler import FileInterpreter
+
+
+def measure(filename, optimisations=None):
+    """
+    Compile and run a program
+
+    :param filename:
+    :param optimisations: passed on to Compiler
+    :return: number of instructions, number of cycles to run, most RAM used
+    """
+    file_interpreter = Compiler(filename, optimisations).low_level_file_interpreter
+    compiled = file_interpreter.compiled
+    interpreter = Interpreter(compiled)
+    # The stack pointer is after the variables, and points past the top of the stack
+    stack = file_interpreter.global_store["<stack>"].offset
+    peak = [stack]
+    interpreter.ram.add_hook(stack, lambda address, value: peak.append(max(peak.pop(), value)))
+    interpreter.run("jit")
+    return len(compiled), interpreter.cycles, peak[0] - 1
+
+
+def report(filenames, optimisations):
+    rows = []
+    for filename in filenames:
+        before = measure(filename)
+        after = measure(filename, optimisations)
+        rows.append((filename,) + before + after)
+    totals = tuple(sum(row[i] for row in rows) for i in range(1, 7))
+    print("{:30} {:>13} {:>17} {:>28}".format("", "instructions", "cycles", "peak RAM"))
+    for row in rows + [("total",) + totals]:
+        name, instructions, cycles, ram, new_instructions, new_cycles, new_ram = row
+        print("{:30} {:>5} -> {:<5} {:>7} -> {:<7} ({:.1%} fewer cycles) {:>5} -> {:<5}".format(
+            name, instructions, new_instructions, cycles, new_cycles, 1 - new_cycles / cycles, ram, new_ram))
+    if set(optimisations) & set(FileInterpreter.compile_optimisations):
+        report_calls(filenames, optimisations)
+
+
+def report_calls(filenames, optimisations):
+    print()
+    for filename in filenames:
+        file_interpreter = Compiler(filename, optimisations).low_level_file_interpreter
+        if file_interpreter.inliner is not None:
+            for sub_name, caller in file_interpreter.inliner.inlined:
+                print("{:30} {} from {}: inlined".format(filename, sub_name, caller))
+        calls = file_interpreter.call_saves
+        for sub_name, caller, saved, total in calls:
+            # A push and a pop are 2 instructions each
+            print("{:30} {} from {}: saves {} of {} variables, {} fewer cycles per call".format(
+                filename, sub_name, caller, saved, total, 4 * (total - saved)))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    passes = FileInterpreter.all_optimisations
+    if args and args[0] == "--passes":
+        passes = args[1].split(",")
+        args = args[2:]
+    report(args, passes)
@@ -1,22 +1,36 @@
-import unittest
+import os
 import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 sys.path.insert(1,'..')
 
+import benchmark
 from compiler import Compiler
-from interpreter.interpreter import Interpreter
+from linker import ObjectModule, Linker, compile_modules
+from interpreter.interpreter import Interpreter, RAM, OPERATIONS
+from interpreter.cfg import ControlFlowGraph
+from low_level_compiler import folding
+from low_level_compiler.low_level_compiler import FileInterpreter
+from low_level_compiler.peephole import PeepholeOptimiser
+from tree_builder.tree_builder import build_tree, load_grammar, find_include, read_include, include_cache
+
+class CompilerTestCase(unittest.TestCase):
+    engine = "reference"
+    optimisations = None
 
-class TestCompiler(unittest.TestCase):
     def setUp(self):
-        super(TestCompiler, self).setUp()
+        super(CompilerTestCase, self).setUp()
 
     def run_prg(self, filename):
-        self.file_interpreter = Compiler(filename).low_level_file_interpreter
+        self.file_interpreter = Compiler(filename, self.optimisations).low_level_file_interpreter
         compiled = "\n".join(self.file_interpreter.compiled)
         #print(compiled)
         interpreter = Interpreter("")
         interpreter.__init__(compiled)
-        interpreter.run()
+        interpreter.run(self.engine)
         self.ram = interpreter.ram
+        self.cycles = interpreter.cycles
 
     def get_ram(self, variables):
         rtn = []
@@ -31,6 +45,8 @@ class TestCompiler(unittest.TestCase):
         return rtn
         #return [self.ram[self.file_interpreter.global_store["main_"+variable].offset] for variable in variables]
 
+
+class TestCompiler(CompilerTestCase):
     def test_assign(self):
         self.run_prg("tests/test_assign.txt")
         self.assertEqual(self.get_ram("a"), [7])
@@ -71,5 +87,265 @@ class TestCompiler(unittest.TestCase):
         self.run_prg("tests/test_complex.txt")
         self.assertEqual(self.get_ram("caefb"), [2,[6,3,1213],1213,5,[6,3,9]])
 
+    def test_conditional_move(self):
+        self.run_prg("tests/test_conditional_move.txt")
+        self.assertEqual(self.get_ram("a"), [2])
+
+    def test_tail_calls(self):
+        self.run_prg("tests/test_tail_calls.txt")
+        self.assertEqual(self.get_ram("a"), [5050])
+
+    def test_inline(self):
+        self.run_prg("tests/test_inline.txt")
+        self.assertEqual(self.get_ram("abc"), [3, 24, 5])
+
+    def test_control_flow_graph(self):
+        self.run_prg("tests/test_recursion.txt")
+        cfg = ControlFlowGraph.from_text(self.file_interpreter.compiled)
+        labels = {block.label: block for block in cfg}
+        self.assertIn(labels["Start factorial"].start, cfg.blocks[0].successors)
+        self.assertEqual(cfg.reachable(), set(cfg.blocks))
+
+
+class TestCompilerJit(TestCompiler):
+    engine = "jit"
+
+
+class TestCompilerOptimised(TestCompiler):
+    optimisations = FileInterpreter.all_optimisations
+
+    def test_jumps_and_nops(self):
+        optimiser = PeepholeOptimiser(2)
+        self.assertEqual(optimiser.optimise(["MLZ -1 5 1",
+                                             "MNZ A1 {} 0; End if_1", "MLZ 0 0 0", "#End if_1",
+                                             "MNZ 0 0 0",
+                                             "MNZ A1 {} 0; End if_2", "MLZ 0 0 0", "ADD A1 1 1", "#End if_2"]),
+                         ["MLZ -1 5 1", "#End if_1", "MNZ A1 {} 0; End if_2", "MLZ 0 0 0", "ADD A1 1 1", "#End if_2"])
+        self.assertEqual(optimiser.removed, 3)
+
+    def test_peephole(self):
+        self.optimisations = ["self_moves", "stack_values", "jumps_to_next", "nops"]
+        self.run_prg("tests/test_calls.txt")
+        self.assertEqual(self.get_ram("abc"), [1, 2, 3])
+        optimised = len(self.file_interpreter.compiled)
+        self.optimisations = None
+        self.run_prg("tests/test_calls.txt")
+        self.assertEqual(self.get_ram("abc"), [1, 2, 3])
+        # The self move, then 4 of the 5 pushes before the second call and 3 of their stack steps
+        self.assertEqual(len(self.file_interpreter.compiled) - optimised, 8)
+
+    def test_live_variables(self):
+        self.optimisations = ["live_variables"]
+        self.run_prg("tests/test_recursion.txt")
+        self.assertEqual(self.get_ram("a"), [120])
+        # Only num is read after the recursive call
+        self.assertEqual(self.file_interpreter.call_saves, [("factorial", "main", 0, 6), ("factorial", "factorial", 1, 6)])
+        cycles = self.cycles
+        self.optimisations = None
+        self.run_prg("tests/test_recursion.txt")
+        self.assertLess(cycles, self.cycles)
+
+    def test_tail_and_leaf_calls(self):
+        self.optimisations = ["tail_calls"]
+        self.run_prg("tests/test_tail_calls.txt")
+        self.assertEqual(self.get_ram("a"), [5050])
+        stack = self.file_interpreter.global_store["<stack>"].offset
+        depths = []
+        interpreter = Interpreter("\n".join(self.file_interpreter.compiled))
+        interpreter.ram.add_hook(stack, lambda address, value: depths.append(value))
+        interpreter.run(self.engine)
+        # Only main's call pushes its 4 variables and a return address, the recursive calls reuse it
+        self.assertEqual(max(depths) - min(depths), 5)
+        self.optimisations = ["leaf_calls"]
+        self.run_prg("tests/test_calls.txt")
+        self.assertEqual(self.get_ram("abc"), [1, 2, 3])
+        # f only writes the scratchpad holding its result
+        self.assertEqual(self.file_interpreter.call_saves, [("f", "main", 1, 5), ("f", "main", 1, 5)])
+
+    def test_inline_subs(self):
+        self.optimisations = ["inline_subs"]
+        self.run_prg("tests/test_inline.txt")
+        self.assertEqual(self.get_ram("abc"), [3, 24, 5])
+        self.assertEqual(self.file_interpreter.inliner.inlined, [("add_twice", "main")] * 2)
+        # Nothing calls add_twice any more
+        self.assertNotIn(("sub", "start", "add_twice"), self.file_interpreter.instruction_list)
+        cycles = self.cycles
+        self.optimisations = None
+        self.run_prg("tests/test_inline.txt")
+        self.assertLess(cycles, self.cycles)
+        # Recursive subroutines and ones with an early return are left alone
+        self.optimisations = ["inline_subs"]
+        for filename in ("tests/test_recursion.txt", "tests/test_prime.txt"):
+            self.run_prg(filename)
+            self.assertEqual(self.file_interpreter.inliner.inlined, [])
+
+    def test_fold_constants(self):
+        self.optimisations = ["fold_constants"]
+        self.run_prg("tests/test_stdint.txt")
+        self.assertEqual(self.get_ram("abcdefghij"), [31,65162,32204,1,0,0,1,65504,1,0])
+        # Setting the stack pointer, one move per variable, then halting
+        self.assertEqual(len(self.file_interpreter.compiled), 13)
+        self.assertTrue(all(" MLZ -1 " in line for line in self.file_interpreter.compiled[:-1]))
+        self.run_prg("tests/test_if.txt")
+        self.assertEqual(self.get_ram("a"), [5])
+        # The condition is always true, so the if is gone
+        self.assertNotIn("if", [instruction[0] for instruction in self.file_interpreter.instruction_list])
+        self.run_prg("tests/test_prime.txt")
+        cycles = self.cycles
+        self.optimisations = None
+        self.run_prg("tests/test_prime.txt")
+        self.assertLess(cycles, self.cycles)
+
+    def test_allocate_ram(self):
+        self.optimisations = ["allocate_ram"]
+        self.run_prg("tests/test_stdint_complex.txt")
+        self.assertEqual(self.get_ram("ab"), [5472, 151])
+        allocator = self.file_interpreter.allocator
+        self.assertEqual((allocator.before, allocator.after), (17, 8))
+        self.assertEqual(self.file_interpreter.global_store["<stack>"].offset, 9)
+        self.run_prg("tests/test_recursion.txt")
+        self.assertEqual(self.get_ram("a"), [120])
+        # num is live across the recursive call, so nothing the call writes can share its address
+        allocator = self.file_interpreter.allocator
+        num = self.file_interpreter.global_store["factorial_num"]
+        self.assertTrue(allocator.interference[num])
+        self.assertNotIn(num.offset, [var.offset for var in allocator.interference[num]])
+
+    def test_delay_slots(self):
+        optimiser = PeepholeOptimiser(2, ["fill_delay_slots"])
+        # The return address can't move past the stack step, nor the stack step before the return
+        self.assertEqual(optimiser.optimise(["MLZ -1 {} A2; EndCall", "ADD A2 1 2", "MLZ -1 {} 0; Start f",
+                                             "MNZ 0 0 0", "#EndCall",
+                                             "MLZ -1 7 5", "SUB A2 1 2", "MLZ -1 B2 0", "MNZ 0 0 0"]),
+                         ["MLZ -1 {} A2; EndCall", "MLZ -1 {} 0; Start f", "ADD A2 1 2", "#EndCall",
+                          "SUB A2 1 2", "MLZ -1 B2 0", "MLZ -1 7 5"])
+        self.assertEqual(optimiser.removed, 2)
+        # Nothing moves into a delay slot past a write to what the jump reads
+        unchanged = ["MLZ -1 5 1", "MNZ A1 {} 0; End", "MLZ 0 0 0", "#End"]
+        self.assertEqual(optimiser.optimise(unchanged), unchanged)
+        self.run_prg("tests/test_prime.txt")
+        cycles = self.cycles
+        self.optimisations = None
+        self.run_prg("tests/test_prime.txt")
+        self.assertLess(cycles, self.cycles)
+
+
+class TestBuild(CompilerTestCase):
+    """
+    Tests of the parser, the caches, the linker and the output formats, which run once rather than for each
+    engine and set of optimisations
+    """
+
+    def test_binary(self):
+        self.run_prg("tests/test_prime.txt")
+        interpreter = Interpreter.from_binary(self.file_interpreter.binary())
+        interpreter.run(self.engine)
+        self.assertEqual(interpreter.ram.dump(), self.ram.dump())
+
+    def test_labels(self):
+        add_jumps = FileInterpreter.add_jumps
+        self.assertEqual(add_jumps(["MLZ -1 {} 0;end", "ADD 1 2 3", "#end", "SUB 1 2 3"]),
+                         ["0. MLZ -1 1 0;", "1. ADD 1 2 3; end", "2. SUB 1 2 3;"])
+        with self.assertRaises(SyntaxError):
+            add_jumps(["MLZ -1 {} 0;nowhere"])
+        with self.assertRaises(SyntaxError):
+            add_jumps(["ADD 1 2 3", "#start", "ADD 1 2 3", "#start"])
+
+    def test_memoise(self):
+        for filename in ("tests/test_complex.txt", "tests/test_stdint_complex.txt"):
+            self.assertEqual(repr(build_tree(filename)), repr(build_tree(filename, memoise=False)))
+
+    def test_parse_threads(self):
+        self.assertIs(load_grammar(), load_grammar())
+        filenames = ["tests/test_complex.txt", "tests/test_stdint_complex.txt", "tests/test_prime.txt"] * 4
+        with ThreadPoolExecutor(4) as executor:
+            trees = list(executor.map(build_tree, filenames))
+        self.assertEqual(list(map(repr, trees)), [repr(build_tree(filename)) for filename in filenames])
+
+    def test_long_program(self):
+        statements = sys.getrecursionlimit() + 100
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "long.txt")
+            with open(filename, "w") as source:
+                source.write(benchmark.generate(statements))
+            tree = build_tree(filename)
+        self.assertEqual(len(tree["stmts"][0]["sub"]["stmts"]["stmts"]), statements + 2)
+
+    def test_includes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "double.txt"), "w") as source:
+                source.write("#include stdint\n#include main\n\nsub double(int x) -> int\n    return x + x\n")
+            with open(os.path.join(directory, "main.txt"), "w") as source:
+                source.write("#include double\n#include stdint\n#include double\n\nsub main\n    int a = double(21)\n")
+            # Found next to main.txt, and each included once even though double.txt includes main.txt back
+            self.run_prg(os.path.join(directory, "main.txt"))
+        self.assertEqual(self.get_ram("a"), [42])
+        stdint = find_include("stdint", None)
+        self.assertIs(read_include(stdint)[1], include_cache[stdint][2])
+
+    def test_incremental(self):
+        def compiled(compiler):
+            # Without the labels, which are numbered differently
+            return [line.split(";")[0] for line in compiler.low_level_file_interpreter.compiled]
+        with open("tests/test_calls.txt") as source:
+            program = source.read()
+        for optimisations in (None, FileInterpreter.all_optimisations):
+            with self.subTest(optimisations=optimisations), tempfile.TemporaryDirectory() as directory:
+                filename = os.path.join(directory, "calls.txt")
+                cache_dir = os.path.join(directory, "cache")
+                # The subs compiled, rather than loaded from the cache, as the program changes
+                for changed, recompiled in ((program, ["f", "main"]),
+                                            (program, []),
+                                            (program.replace("x + 1", "x + 2"), ["f"])):
+                    with open(filename, "w") as source:
+                        source.write(changed)
+                    compiler = Compiler(filename, optimisations, cache_dir)
+                    self.assertEqual(compiler.high_level_file_interpreter.recompiled, recompiled)
+                    self.assertEqual(compiled(compiler), compiled(Compiler(filename, optimisations)))
+
+    def test_link(self):
+        for optimisations in (None, FileInterpreter.all_optimisations):
+            with self.subTest(optimisations=optimisations), tempfile.TemporaryDirectory() as directory:
+                with open(os.path.join(directory, "maths.txt"), "w") as source:
+                    source.write("#include stdint\n\nsub f(int x) -> int\n    return x + 1\n\n"
+                                 "sub g(int x, int y) -> int\n    int z = f(x)\n    return z * y\n")
+                with open(os.path.join(directory, "main.txt"), "w") as source:
+                    source.write("#include stdint\n\nsub main\n    int a = 2\n    int b = f(a)\n    int c = g(b, 5)\n")
+                maths, main = compile_modules([os.path.join(directory, "maths.txt"),
+                                               os.path.join(directory, "main.txt")], optimisations)
+                self.assertEqual(main.imports, {"f", "g"})
+                # Linked from the saved module, without compiling it again
+                maths.save(os.path.join(directory, "maths.qobj"))
+                maths = ObjectModule.load(os.path.join(directory, "maths.qobj"))
+                linker = Linker([maths, main], optimisations)
+                interpreter = Interpreter("\n".join(linker.compiled))
+                interpreter.run(self.engine)
+                self.assertEqual([interpreter.ram[linker.address(main, "main_" + name)] for name in "abc"],
+                                 [2, 3, 20])
+                with self.assertRaises(SyntaxError):
+                    Linker([main], optimisations)
+
+    def test_fold_operations(self):
+        # Constants fold to what the interpreter would work out when running the opcode
+        self.assertEqual((folding.max_value, folding.negative_bit), (RAM.max_value, RAM.negative_bit))
+        constants = {"negative_bit": RAM.negative_bit, "max_value": RAM.max_value}
+        values = [0, 1, 2, 3, 15, 16, 17, 31, 32, 33, 4660, 32767, 32768, 32769, 65534, 65535]
+        self.assertEqual(folding.OPERATIONS.keys() | folding.CONDITIONS.keys(),
+                         {"__{}__".format(name) for name in Interpreter.opcode_names})
+        for name, (condition, value) in zip(Interpreter.opcode_names, OPERATIONS):
+            opcode = "__{}__".format(name)
+            with self.subTest(opcode=opcode):
+                if condition is not None:
+                    self.assertIn(opcode, folding.CONDITIONS)
+                    for a in values:
+                        self.assertEqual(folding.CONDITIONS[opcode](a),
+                                         bool(eval(condition.format(**constants), {"a": a})))
+                    continue
+                for a in values:
+                    for b in values:
+                        self.assertEqual(folding.OPERATIONS[opcode](a, b) & RAM.max_value,
+                                         eval(value.format(**constants), {"a": a, "b": b}) & RAM.max_value)
+
+
 if __name__ == '__main__':
     unittest.main()
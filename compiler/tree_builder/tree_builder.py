@@ -1,11 +1,22 @@
+import hashlib
+import os
+import threading
 import tokenize
 from xml.etree import ElementTree
 
 from typing import Optional
 
+grammar_filename = os.path.join(os.path.dirname(__file__), "grammar.xml")
+
 
 class GrammarParser:
-    def __init__(self, filename="tree_builder/grammar.xml"):
+    """
+    The parsers for each define in a grammar
+
+    Nothing is changed once it is built, anything that changes while parsing is in a ParseState, so
+    one GrammarParser can parse any number of files at once.
+    """
+    def __init__(self, filename=grammar_filename):
         self.grammar_xml = ElementTree.parse(filename).getroot()
         assert self.grammar_xml.tag == "grammar"
         self.start_stmt = self.grammar_xml.attrib["start"]
@@ -14,12 +25,51 @@ class GrammarParser:
             self.stmts[stmt_definition.attrib["name"]] = DefineParser(stmt_definition)
         assert self.start_stmt in self.stmts
 
-    def accepts(self, tokens) -> Optional["GrammarTree"]:
-        new_tokens, accepts = self.stmts[self.start_stmt].accepts(tokens)
+    def accepts(self, state: "ParseState") -> Optional["GrammarTree"]:
+        position, accepts = self.stmts[self.start_stmt].accepts(state, 0)
         if accepts:
             return accepts
 
 
+# Loaded grammars, by filename and hash of the XML
+grammar_cache = {}
+grammar_cache_lock = threading.Lock()
+
+
+def load_grammar(filename=grammar_filename) -> GrammarParser:
+    """
+    Build the parsers for a grammar once, and again only if the XML changes
+
+    :param filename:
+    :return:
+    """
+    with open(filename, "rb") as grammar_file:
+        key = os.path.abspath(filename), hashlib.sha256(grammar_file.read()).hexdigest()
+    with grammar_cache_lock:
+        if key not in grammar_cache:
+            grammar_cache[key] = GrammarParser(filename)
+        return grammar_cache[key]
+
+
+class ParseState:
+    def __init__(self, grammar: GrammarParser, filename: str, tokens: list, memoise: bool = True):
+        """
+        Everything that changes while parsing one file
+
+        :param grammar:
+        :param filename:
+        :param tokens: all the tokens of the file
+        :param memoise: remember what each define parsed to at each position, so nothing is parsed twice
+        """
+        self.grammar = grammar
+        self.tokens = tokens
+        # TokenInfo.exact_type is worked out on every read
+        self.exact_types = [token.exact_type for token in tokens]
+        # (define name, position): what DefineParser.accepts returned
+        self.memo = {} if memoise else None
+        self.errors = ErrorTree(filename, tokens)
+
+
 class DefineParser:
     def __init__(self, root):
         self._root = root
@@ -27,21 +77,29 @@ class DefineParser:
         self.name = self._root.attrib["name"]
         self.blocks = [BlockParser(block) for block in self._root.findall("block")]
 
-    def accepts(self, tokens):
-        #print("StartDef", self.name)
-        # if self.name == "if":
-        #    print("Tokens", [tokenize.tok_name[token.exact_type]for token in tokens])
-        #    print("Tokens", [token.string for token in tokens])
+    def accepts(self, state, position):
+        """
+        Parse the define at `position`, at most once per position when memoising
+
+        :param state:
+        :param position: index of the first token to parse
+        :return: the position after it, and the GrammarTree or False
+        """
+        memo = state.memo
+        key = self.name, position
+        if memo is not None and key in memo:
+            return memo[key]
+        rtn = position, False
         for block in self.blocks:
-            new_tokens, accepts = block.accepts(tokens)
-            # print("B", block, "A", accepts)
+            new_position, accepts = block.accepts(state, position)
             if accepts:
-                grammar_tree = GrammarTree(self.name, accepts)
-                #print("EndDef", self.name)
-                return new_tokens, grammar_tree
-        #print("FailDef", self.name)
-        error_msg.fail_def(new_tokens)
-        return tokens, False
+                rtn = new_position, GrammarTree(self.name, accepts)
+                break
+        else:
+            state.errors.fail_def(position)
+        if memo is not None:
+            memo[key] = rtn
+        return rtn
 
 
 class BlockParser:
@@ -62,12 +120,12 @@ class BlockParser:
     def __repr__(self):
         return str(self.stmts)
 
-    def accepts(self, tokens):
+    def accepts(self, state, position):
         stmts = []
         for statement in self.stmts:
-            new_tokens, accepts = statement.accepts(tokens)
+            new_position, accepts = statement.accepts(state, position)
             if not accepts:
-                return tokens, False
+                return position, False
             if isinstance(statement, RepeatParser):
                 filtered = (stmt for stmt in accepts if stmt is not True)
                 accepts = [GrammarTree(statement.name+"_"+str(i), stmt) for i, stmt in enumerate(filtered)]
@@ -77,13 +135,13 @@ class BlockParser:
                 stmts.extend(accepts)
             else:
                 stmts.append(accepts)
-            tokens = new_tokens
+            position = new_position
         if "name" in self._root.attrib:
             name = self._root.attrib["name"]
             stmts.append(("_block_name", name))
             if name == "_":
-                return tokens, True
-        return tokens, stmts
+                return position, True
+        return position, stmts
 
 
 class RepeatParser:
@@ -93,18 +151,22 @@ class RepeatParser:
         self.blocks = [BlockParser(block) for block in self._root.findall("block")]
         self.name = self._root.attrib["name"]
 
-    def accepts(self, tokens, accepts=None):
-        if accepts is None:
-            accepts = []
-        for block in self.blocks:
-            new_tokens, block_accepts = block.accepts(tokens)
-            if block_accepts:
-                accepts.append(block_accepts)
-                return self.accepts(new_tokens, accepts)
+    def accepts(self, state, position):
+        accepts = []
+        # Until none of the blocks match at the position reached
+        while 1:
+            for block in self.blocks:
+                new_position, block_accepts = block.accepts(state, position)
+                if block_accepts:
+                    accepts.append(block_accepts)
+                    position = new_position
+                    break
+            else:
+                break
         if accepts:
-            return tokens, accepts
+            return position, accepts
         else:
-            return tokens, False
+            return position, False
 
 
 class TokenParser:
@@ -112,23 +174,30 @@ class TokenParser:
         self._root = root
         assert self._root.tag == "token"
         self.attrib = self._root.attrib
+        # Exact type to match as a number, and the other attributes to match
+        self.exact_type = None
+        self.checks = []
+        for attr, value in self.attrib.items():
+            if attr == "exact_type":
+                self.exact_type = getattr(tokenize, value)
+            elif attr == "type":
+                self.checks.append((attr, getattr(tokenize, value)))
+            elif attr != "var":
+                self.checks.append((attr, value))
 
     def __repr__(self):
         return "TokenParser%s"%self.attrib
 
-    def accepts(self, tokens):
-        for attr in self.attrib:
-            if attr == "var":
-                continue
-            token_value = getattr(tokens[0], attr)
-            if attr in ("exact_type", "type"):
-                token_value = tokenize.tok_name[token_value]
-            if token_value != self.attrib[attr]:
-                # print("TokenFAIL", attr, self.attrib[attr], "was", token_value)
-                return tokens, False
+    def accepts(self, state, position):
+        if self.exact_type is not None and state.exact_types[position] != self.exact_type:
+            return position, False
+        token = state.tokens[position]
+        for attr, value in self.checks:
+            if getattr(token, attr) != value:
+                return position, False
         if "var" in self.attrib:
-            return tokens[1:], (self.attrib["var"], tokens[0].string)
-        return tokens[1:], True
+            return position + 1, (self.attrib["var"], token.string)
+        return position + 1, True
 
 
 class StmtParser:
@@ -140,13 +209,15 @@ class StmtParser:
     def __repr__(self):
         return "StmtParser(%s)"%self.name
 
-    def accepts(self, tokens):
-        new_tokens, accepts = grammar_parser.stmts[self.name].accepts(tokens)
+    def accepts(self, state, position):
+        new_position, accepts = state.grammar.stmts[self.name].accepts(state, position)
         if accepts:
             if "var" in self._root.attrib:
+                # The memoised tree is shared by every stmt parsed at this position
+                accepts = accepts.copy()
                 accepts["_stmt_var"] = self._root.attrib["var"]
-            return new_tokens, (self.name, accepts)
-        return tokens, False
+            return new_position, (self.name, accepts)
+        return position, False
 
 
 class OptionalParser(BlockParser):
@@ -158,25 +229,27 @@ class OptionalParser(BlockParser):
         self.name = self._root.attrib["name"]
         assert self._root.tag == "optional"
 
-    def accepts(self, tokens):
-        tokens, accepts = super().accepts(tokens)
+    def accepts(self, state, position):
+        position, accepts = super().accepts(state, position)
         if not accepts:
             accepts = [("_"+self.name, False)]
-            return tokens, accepts
-        return tokens, accepts+[("_"+self.name, True)]
+            return position, accepts
+        return position, accepts+[("_"+self.name, True)]
 
 
 class ErrorTree:
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, tokens: list):
         self.filename = filename
+        self.tokens = tokens
+        # Furthest position a define failed to parse at
         self.error = None
 
-    def fail_def(self, new_tokens):
-        if self.error is None or len(new_tokens) < len(self.error):
-            self.error = new_tokens
+    def fail_def(self, position: int):
+        if self.error is None or position > self.error:
+            self.error = position
 
     def __repr__(self):
-        error_token = self.error[0]
+        error_token = self.tokens[self.error]
         rtn = "File %r, line %d\n\t%s\n\t%s"%(self.filename,
                                               error_token.start[0],
                                               error_token.line.strip("\n"),
@@ -198,6 +271,11 @@ class GrammarTree:
                 i += 1
             self._dict[key] = value
 
+    def copy(self) -> "GrammarTree":
+        rtn = GrammarTree(self.name, [])
+        rtn._dict = dict(self._dict)
+        return rtn
+
     def __setitem__(self, key, value):
         self._dict[key] = value
 
@@ -220,39 +298,195 @@ class GrammarTree:
         raise AttributeError("Tried to get stmt %s from %s"%(var, self))
 
 
-def tokenise(inp):
+# Directories searched for an include after the including file's, the working directory and the one
+# stdint is in
+include_path = [os.curdir, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+# Tokenised includes by absolute path: (modification time, includes, tokens) as read_tokens returns them
+include_cache = {}
+include_cache_lock = threading.Lock()
+
+
+def read_tokens(inp):
+    """
+    Tokenise a file, without the files it includes
+
+    :param inp: file opened in binary mode
+    :return: (position in the tokens, name) of each #include, the tokens before the ENDMARKER, the ENDMARKER
+    """
     tokens = tokenize.tokenize(inp.readline)
     # Get rid of the encoding token
     next(tokens)
     rtn = []
+    includes = []
     # Replace NL tokens with NEWLINE tokens
     purge_comments = False
     for i, token in enumerate(tokens):
         if tokenize.tok_name[token.exact_type] == "NL":
             rtn.append(type(token)(tokenize.NEWLINE, token.string, token.start, token.end, token.line))
         elif not purge_comments and tokenize.tok_name[token.exact_type] == "COMMENT" and token.string.startswith("#include"):
-            with open(token.string[9:] + ".txt", "rb") as include_file:
-                rtn.extend(tokenise(include_file)[:-1])
+            includes.append((len(rtn), token.string[9:]))
         elif tokenize.tok_name[token.exact_type] == "COMMENT":
             # TODO: hack, find a better fix
             rtn.append(type(token)(tokenize.NEWLINE, token.string, token.start, token.end, token.line))
-        else:
+        elif token.exact_type != tokenize.ENDMARKER:
             purge_comments = True
             rtn.append(token)
+    return includes, rtn, token
+
+
+def find_include(name: str, including: Optional[str]) -> str:
+    """
+    The absolute path of an included file
+
+    :param name: as written after #include, without the .txt
+    :param including: path of the file including it, None to only search include_path
+    :return:
+    """
+    directories = include_path if including is None else [os.path.dirname(including)] + include_path
+    for directory in directories:
+        path = os.path.abspath(os.path.join(directory, name + ".txt"))
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError("Can't find %r included from %r in %s" % (name, including, directories))
+
+
+def read_include(path: str):
+    """
+    read_tokens for an included file, only reading it again if it's changed since
+
+    :param path: absolute path
+    :return:
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with include_cache_lock:
+        cached = include_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1:]
+    with open(path, "rb") as include_file:
+        includes, tokens, end = read_tokens(include_file)
+    with include_cache_lock:
+        include_cache[path] = mtime, includes, tokens
+    return includes, tokens
+
+
+def expand(includes: list, tokens: list, filename: Optional[str], included: set) -> list:
+    """
+    Tokens with the tokens of each file included in place of its #include
+
+    :param includes: (position in the tokens, name) of each #include
+    :param tokens:
+    :param filename: path of the file the tokens are from
+    :param included: absolute paths of the files already included, which aren't included again
+    :return:
+    """
+    rtn = []
+    start = 0
+    for position, name in includes:
+        rtn.extend(tokens[start:position])
+        start = position
+        path = find_include(name, filename)
+        if path not in included:
+            included.add(path)
+            rtn.extend(expand(*read_include(path), path, included))
+    rtn.extend(tokens[start:])
     return rtn
 
 
-def build_tree(filename):
-    global grammar_parser
-    global error_msg
-    error_msg = ErrorTree(filename)
-    grammar_parser = GrammarParser()
+def tokenise(inp, filename: Optional[str] = None):
+    """
+    Tokenise a file, with the tokens of each file it includes in place of its #include
+
+    Each file is only included once, the first time it is. Included files are found next to the file
+    including them, then in include_path.
+
+    :param inp: file opened in binary mode
+    :param filename: path of the file, None if it isn't in one
+    :return:
+    """
+    includes, tokens, end = read_tokens(inp)
+    included = set() if filename is None else {os.path.abspath(filename)}
+    return expand(includes, tokens, filename, included) + [end]
+
+
+def build_tree(filename, memoise=True):
+    """
+    Parse a file into a GrammarTree
+
+    :param filename:
+    :param memoise: remember what each define parsed to at each position, so nothing is parsed twice
+    :return:
+    """
     with open(filename, "rb") as inp:
-        tokens = tokenise(inp)
-        rtn = grammar_parser.accepts(tokens)
-        if rtn is None:
-            raise SyntaxError("Bad Syntax\n%s"%error_msg)
-        return rtn
+        tokens = tokenise(inp, filename)
+    state = ParseState(load_grammar(), filename, tokens, memoise)
+    rtn = state.grammar.accepts(state)
+    if rtn is None:
+        raise SyntaxError("Bad Syntax\n%s"%state.errors)
+    return rtn
+
+
+def split_units(tokens: list) -> list:
+    """
+    Find each top level definition in a file, a sub, operator or struct
+
+    :param tokens: all the tokens of the file
+    :return: (start, end) positions of each, with the end after its last DEDENT
+    """
+    rtn = []
+    depth = 0
+    start = None
+    for position, token in enumerate(tokens):
+        if token.exact_type == tokenize.INDENT:
+            depth += 1
+        elif token.exact_type == tokenize.DEDENT:
+            depth -= 1
+            if depth == 0 and start is not None:
+                rtn.append((start, position + 1))
+                start = None
+        elif depth == 0 and start is None and token.exact_type not in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            start = position
+    return rtn
+
+
+class UnitParser:
+    def __init__(self, filename: str):
+        """
+        Tokenise a file, to parse its top level definitions one at a time
+
+        :param filename:
+        """
+        with open(filename, "rb") as inp:
+            tokens = tokenise(inp, filename)
+        self.state = ParseState(load_grammar(), filename, tokens)
+        self.units = split_units(tokens)
+
+    def text(self, unit: tuple) -> str:
+        """
+        The tokens of a unit without their positions, which are the same wherever it is in the file
+
+        :param unit: (start, end) from self.units
+        :return:
+        """
+        start, end = unit
+        return " ".join("%d:%r" % (token.exact_type, token.string) for token in self.state.tokens[start:end])
+
+    def parse(self, unit: tuple) -> GrammarTree:
+        """
+        Parse a unit into one of the stmts of the file
+
+        :param unit: (start, end) from self.units
+        :return:
+        """
+        start, end = unit
+        grammar = self.state.grammar
+        # The repeat in the start define, which the top level definitions are blocks of
+        repeat = grammar.stmts[grammar.start_stmt].blocks[0].stmts[0]
+        for block in repeat.blocks:
+            position, accepts = block.accepts(self.state, start)
+            if accepts and position == end:
+                return GrammarTree(repeat.name + "_0", accepts)
+        raise SyntaxError("Bad Syntax\n%s"%self.state.errors)
+
 
 if __name__ == "__main__":
     print(build_tree("primes.txt"))
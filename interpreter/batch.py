@@ -0,0 +1,76 @@
+"""
+Run many independent QFTASM programs across a pool of processes
+
+Jobs and results are plain data, so only the program text and the final
+state cross between processes, never an Interpreter.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from interpreter import Interpreter, ArrayRAM, halt_on
+
+
+class Job:
+    def __init__(self, program: str, max_cycles: int = None, ram: dict = None, halts: dict = None,
+                 engine: str = "jit", array_ram: bool = False, addresses: range = None):
+        """
+        A program to run, and what to run it with
+
+        :param program: QFTASM source, or bytes in the binary format which load faster
+        :param max_cycles: most instructions to run, None for no limit
+        :param ram: address: value to load before running, eg. the program's input
+        :param halts: address: value to halt the program on when written
+        :param engine: name of the Interpreter engine
+        :param array_ram: whether to use ArrayRAM
+        :param addresses: only return these addresses of RAM, None for all
+        """
+        self.program = program
+        self.max_cycles = max_cycles
+        self.ram = ram or {}
+        self.halts = halts or {}
+        self.engine = engine
+        self.array_ram = array_ram
+        self.addresses = addresses
+
+    def run(self) -> dict:
+        """
+        Run the job in this process
+
+        :return: Interpreter.get_state with the halt reason added, see Interpreter.run
+        """
+        ram_type = ArrayRAM if self.array_ram else None
+        if isinstance(self.program, bytes):
+            interpreter = Interpreter.from_binary(self.program, ram_type)
+        else:
+            interpreter = Interpreter(self.program, ram_type)
+        interpreter.ram.load(self.ram)
+        for address, value in self.halts.items():
+            interpreter.ram.add_hook(address, halt_on(value))
+        reason = interpreter.run(self.engine, self.max_cycles)
+        state = interpreter.get_state()
+        if self.addresses is not None:
+            state["ram"] = {address: state["ram"][address] for address in self.addresses
+                            if address in state["ram"]}
+        state["reason"] = reason
+        return state
+
+
+def run_job(job: Job) -> dict:
+    return job.run()
+
+
+def run_batch(jobs: list, workers: int = None, chunksize: int = None) -> list:
+    """
+    Run each job in a pool of processes
+
+    :param jobs: list of Job
+    :param workers: number of processes, defaults to one per CPU
+    :param chunksize: jobs sent to a process at a time, defaults to splitting
+        the jobs into a few chunks per process
+    :return: the result of each Job.run, in the same order as the jobs
+    """
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(run_job, jobs, chunksize=chunksize))
@@ -0,0 +1,249 @@
+"""
+Control flow analysis for QFTASM programs
+
+Builds basic blocks and the edges between them from either the text form
+(such as low_level_compiler.FileInterpreter.compiled) or an Interpreter.
+
+A write to address 0 is a jump. The instruction after a jump has already
+been fetched when the jump happens, so it always runs (the delay slot) and
+the program continues from the written address + 1.
+
+Jumps to an address read from RAM (such as returns from subroutines) are
+assumed to go to an address that appears as a literal somewhere in the
+program, which holds for the low level compiler's output.
+"""
+from typing import Optional
+
+try:
+    from .interpreter import Interpreter, RAM
+except ImportError:
+    # Run from this directory rather than as part of the package
+    from interpreter import Interpreter, RAM
+
+
+class Instruction:
+    def __init__(self, index: int, opcode: str, operands: list, comment: str = ""):
+        """
+        A single decoded QFTASM instruction
+
+        :param index:
+        :param opcode: name of the opcode, eg. "MLZ"
+        :param operands: (layers, address) for each operand
+        :param comment: text after the semicolon
+        """
+        self.index = index
+        self.opcode = opcode
+        self.operands = operands
+        self.comment = comment
+
+    def __repr__(self):
+        operands = " ".join(" ABC"[layers].strip() + str(address) for layers, address in self.operands)
+        return "{}. {} {};".format(self.index, self.opcode, operands)
+
+    @property
+    def writes_pc(self) -> bool:
+        """
+        Whether the instruction can write to the PC with a literal destination
+        """
+        layers, address = self.operands[2]
+        return layers == 0 and address == 0 and self.condition is not False
+
+    @property
+    def computed_write(self) -> bool:
+        """
+        Whether the destination is read from RAM, so could be the PC
+        """
+        return self.operands[2][0] > 0
+
+    @property
+    def condition(self) -> Optional[bool]:
+        """
+        True or False if the write always or never happens, None if unknown
+        """
+        if self.opcode not in ("MNZ", "MLZ"):
+            return True
+        layers, test = self.operands[0]
+        if layers:
+            return None
+        if self.opcode == "MNZ":
+            return test != 0
+        return bool(test & RAM.negative_bit)
+
+    @property
+    def target(self) -> Optional[int]:
+        """
+        The literal address written to the PC by a jump, None if computed
+        """
+        if self.opcode not in ("MNZ", "MLZ"):
+            return None
+        layers, value = self.operands[1]
+        if layers:
+            return None
+        return value
+
+
+class BasicBlock:
+    def __init__(self, start: int, end: int):
+        """
+        Instructions start to end (exclusive) that always run in sequence
+
+        :param start:
+        :param end:
+        """
+        self.start = start
+        self.end = end
+        self.successors = []
+        self.predecessors = []
+        # Index of the jump ending the block and its delay slot
+        self.jump = None
+        self.delay_slot = None
+        # Whether the block ends in a jump to an address read from RAM
+        self.computed = False
+        # Whether the block writes to an address read from RAM, which could be the PC
+        self.computed_writes = False
+        self.label = None
+
+    def __repr__(self):
+        return "BasicBlock({}-{} -> {})".format(self.start, self.end - 1,
+                                                self.successors + ["?"] * self.computed)
+
+    def __contains__(self, index):
+        return self.start <= index < self.end
+
+    def __len__(self):
+        return self.end - self.start
+
+
+class ControlFlowGraph:
+    def __init__(self, instructions: list):
+        """
+        Split a program into basic blocks and link them
+
+        :param instructions: list of Instruction
+        """
+        self.instructions = instructions
+        self.jumps = [inst.index for inst in instructions if inst.writes_pc]
+        self.computed_writes = [inst.index for inst in instructions if inst.computed_write]
+        # Static jump targets: the instruction run after the delay slot
+        self.jump_targets = {}
+        for jump in self.jumps:
+            target = instructions[jump].target
+            if target is not None:
+                self.jump_targets[jump] = (target + 1) & RAM.max_value
+        self.leaders = self.find_leaders()
+        # Blocks whose address is stored in RAM, which computed jumps can reach
+        literals = {(inst.operands[1][1] + 1) & RAM.max_value for inst in instructions
+                    if inst.operands[1][0] == 0 and inst.operands[2] != (0, 0)}
+        self.address_taken = sorted(literals.intersection(self.leaders))
+        self.blocks = {}
+        for start, end in zip(self.leaders, self.leaders[1:] + [len(instructions)]):
+            self.blocks[start] = BasicBlock(start, end)
+        self.link()
+        self.add_labels()
+
+    @classmethod
+    def from_text(cls, lines) -> "ControlFlowGraph":
+        """
+        Build the graph from QFTASM source lines, eg. FileInterpreter.compiled
+
+        The lines are parsed by Interpreter.parse, so they're checked the same way as when they're run.
+
+        :param lines:
+        :return:
+        """
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        lines = list(lines)
+        # The text after the semicolon of each line Interpreter.parse doesn't skip
+        comments = [comment.strip() for code, semicolon, comment in (line.partition(";") for line in lines)
+                    if code.strip()]
+        return cls.from_interpreter(Interpreter(lines), comments)
+
+    @classmethod
+    def from_interpreter(cls, interpreter, comments: list = None) -> "ControlFlowGraph":
+        """
+        Build the graph from an Interpreter's decoded instructions
+
+        :param interpreter:
+        :param comments: the text after the semicolon of each instruction, None for none
+        :return:
+        """
+        comments = comments or [""] * len(interpreter.decoded)
+        return cls([Instruction(i, interpreter.opcode_names[op_id], list(operands), comment)
+                    for i, ((op_id, operands), comment) in enumerate(zip(interpreter.decoded, comments))])
+
+    def __iter__(self):
+        return iter(self.blocks[start] for start in self.leaders)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def find_leaders(self) -> list:
+        leaders = {0}
+        for jump in self.jumps:
+            # Control continues after the delay slot, whether the jump is taken or not
+            leaders.add(jump + 2)
+            if jump in self.jump_targets:
+                leaders.add(self.jump_targets[jump])
+        return sorted(leader for leader in leaders if leader < len(self.instructions))
+
+    def link(self):
+        for block in self.blocks.values():
+            jumps = [jump for jump in self.jumps if jump in block]
+            block.computed_writes = any(index in block for index in self.computed_writes)
+            if not jumps:
+                self.add_edge(block, block.end)
+                continue
+            # A jump whose delay slot starts the next block still ends this one
+            jump = jumps[0]
+            block.jump = jump
+            block.delay_slot = jump + 1 if jump + 1 < len(self.instructions) else None
+            if jump in self.jump_targets and len(jumps) == 1:
+                self.add_edge(block, self.jump_targets[jump])
+            else:
+                # Either the target is read from RAM, or the delay slot jumps too
+                block.computed = True
+                for target in self.address_taken:
+                    self.add_edge(block, target)
+            if self.instructions[jump].condition is None:
+                self.add_edge(block, jump + 2)
+
+    def add_edge(self, block: BasicBlock, target: int):
+        # Running off the end of the program halts it
+        if target in self.blocks and target not in block.successors:
+            block.successors.append(target)
+            self.blocks[target].predecessors.append(block.start)
+
+    def add_labels(self):
+        # The low level compiler puts a label on the instruction before its target
+        for block in self.blocks.values():
+            if block.start > 0 and self.instructions[block.start - 1].comment:
+                block.label = self.instructions[block.start - 1].comment
+
+    def block_at(self, index: int) -> BasicBlock:
+        """
+        Find the block containing an instruction
+
+        :param index:
+        :return:
+        """
+        for start in reversed(self.leaders):
+            if start <= index:
+                return self.blocks[start]
+        raise IndexError("No instruction {}".format(index))
+
+    def reachable(self) -> set:
+        """
+        Start of every block that can be reached from the entry point
+
+        :return:
+        """
+        seen = set()
+        todo = [0] if self.blocks else []
+        while todo:
+            start = todo.pop()
+            if start in seen:
+                continue
+            seen.add(start)
+            todo.extend(self.blocks[start].successors)
+        return seen
@@ -0,0 +1,36 @@
+"""
+Convert QFTASM programs between text and the binary format
+
+    python convert.py primes.qftasm primes.qftb
+    python convert.py primes.qftb primes.qftasm
+
+Files ending in .qftb are binary, anything else is text.
+"""
+import sys
+
+from interpreter import Interpreter
+
+
+def convert(source: str, destination: str):
+    """
+    Convert the program in `source`, writing it to `destination`
+
+    :param source:
+    :param destination:
+    :return:
+    """
+    if source.endswith(".qftb"):
+        interpreter = Interpreter.load(source)
+    else:
+        with open(source) as assembly_file:
+            interpreter = Interpreter(assembly_file)
+    if destination.endswith(".qftb"):
+        with open(destination, "wb") as binary_file:
+            binary_file.write(interpreter.to_binary())
+    else:
+        with open(destination, "w") as assembly_file:
+            assembly_file.write(interpreter.to_text() + "\n")
+
+
+if __name__ == "__main__":
+    convert(sys.argv[1], sys.argv[2])
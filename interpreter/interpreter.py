@@ -1,7 +1,59 @@
+import io
+import mmap
+import re
+import struct
 import sys
+from array import array
+
+# Python expressions for the value each opcode writes, indexed in the same
+# order as Interpreter.opcodes. MNZ and MLZ also have a condition on `a`.
+OPERATIONS = [("a != 0", "b"),
+              ("a & {negative_bit}", "b"),
+              (None, "a + b"),
+              (None, "a - b"),
+              (None, "a & b"),
+              (None, "a | b"),
+              (None, "a ^ b"),
+              (None, "a & ~b"),
+              (None, "a << b"),
+              (None, "(a - {max_value} - 1 if a & {negative_bit} else a) >> b"),
+              (None, "a >> b"),
+              ]
+
+_handler_factories = {}
+
+# Binary programs are a header followed by a fixed size record per instruction:
+# the opcode index, the layers of each operand two bits apiece, then the three addresses
+BINARY_MAGIC = b"QFT\x01"
+BINARY_HEADER = struct.Struct("<4sI")
+BINARY_INSTRUCTION = struct.Struct("<BBHHH")
+
+
+class Halt(Exception):
+    def __init__(self, reason: str = "halt"):
+        """
+        Raised by a RAM hook to stop the program, Interpreter.run returns the reason
+
+        :param reason:
+        """
+        super().__init__(reason)
+        self.reason = reason
+        # The next instruction to run, set by RAM.write_hooked
+        self.pc = None
+
 
 class Interpreter:
-    def __init__(self, inp: str):
+    opcode_names = ["MNZ", "MLZ", "ADD", "SUB", "AND", "OR", "XOR", "ANT", "SL", "SRL", "SRA"]
+    # Most instructions a compiled block runs before returning
+    max_block_length = 256
+
+    def __init__(self, inp, ram_type: type = None):
+        """
+        Load a program
+
+        :param inp: QFTASM source as a string, a file object or any iterable of lines
+        :param ram_type:
+        """
         self.opcodes = {"MNZ": self.mov_not_zero,
                         "MLZ": self.mov_less_zero,
                         "ADD": self.add,
@@ -14,23 +66,23 @@ class Interpreter:
                         "SRL": self.shift_right_logic,
                         "SRA": self.shift_right_arith,
                         }
-        self.ram = RAM()
-        self.tokens = [self.tokenise(line) for line in inp.splitlines()]
-
-    def tokenise(self, line):
-        # Remove comments
-        code, semicolon, comment = line.partition(";")
-        # Lines must have a semicolon
-        if not semicolon:
-            raise SyntaxError("%s: No semicolon ending"%(line))
-        line_no, opcode_id, *operands = code.split()
-        line_no = int(line_no.rstrip("."))
-        opcode = self.opcodes[opcode_id]
-        operands = list(map(self.parse_operand, operands))
-        return opcode, operands
-
-    def parse_operand(self, operand: str) -> "RamLocation":
-        return RamLocation(self.ram, operand)
+        self.engines = {"reference": self.run_reference,
+                        "decoded": self.run_decoded,
+                        "jit": self.run_jit,
+                        }
+        self.ram = (ram_type or RAM)()
+        if isinstance(inp, str):
+            inp = io.StringIO(inp)
+        self.decoded = list(self.parse(inp))
+        # The reference engine's tokens, built when it first runs
+        self.tokens = None
+        # The next instruction to run. This differs from RAM[0] in a delay slot
+        self.pc = 0
+        # Instructions run so far
+        self.cycles = 0
+        self.steps = None
+        self.blocks = None
+        self.compiled_for = None
 
     def mov_not_zero(self, test: int, value: int, dest: int):
         if test != 0:
@@ -67,31 +119,434 @@ class Interpreter:
     def shift_right_arith(self, val1: int, val2: int, dest: int):
         self.ram[dest] = val1 >> val2
 
-    def run(self):
+    def parse(self, lines):
+        """
+        Decode lines into (opcode index, ((layers, address), ...)) tuples as they are read
+
+        Blank and comment only lines are skipped. Each instruction must be
+        numbered with its position in the program. The first malformed line
+        raises a SyntaxError with its line number, before any later lines are read.
+
+        :param lines: iterable of lines
+        :return: generator of decoded instructions
+        """
+        opcode_ids = {opcode: i for i, opcode in enumerate(self.opcode_names)}
+        filename = getattr(lines, "name", "<qftasm>")
+        position = 0
+        for line_no, line in enumerate(lines, 1):
+            code, semicolon, comment = line.partition(";")
+            if not code.strip():
+                continue
+            details = (filename, line_no, None, line.rstrip("\n"))
+            # Lines must have a semicolon
+            if not semicolon:
+                raise SyntaxError("No semicolon ending", details)
+            fields = code.split()
+            if len(fields) < 2:
+                raise SyntaxError("Expected a numbered instruction", details)
+            number, opcode_id, *operands = fields
+            if number.rstrip(".") != str(position):
+                raise SyntaxError("Expected instruction %d, got %s"%(position, number), details)
+            if opcode_id not in opcode_ids:
+                raise SyntaxError("Unknown opcode %s"%opcode_id, details)
+            if len(operands) != 3:
+                raise SyntaxError("Expected 3 operands, got %d"%len(operands), details)
+            try:
+                operands = tuple(self.decode_operand(operand) for operand in operands)
+            except ValueError:
+                raise SyntaxError("Invalid operand", details) from None
+            yield opcode_ids[opcode_id], operands
+            position += 1
+
+    def decode_operand(self, operand: str) -> tuple:
+        layers = "ABC".find(operand[0]) + 1
+        return layers, self.ram.fix_value(int(operand[layers > 0:]))
+
+    @classmethod
+    def from_binary(cls, data, ram_type: type = None) -> "Interpreter":
+        """
+        Load a program written by to_binary
+
+        The instructions are unpacked straight from the buffer, without
+        any text parsing. Tokens for the reference engine are only built
+        when it runs.
+
+        :param data: bytes, or anything supporting the buffer protocol such as an mmap
+        :param ram_type:
+        :return:
+        """
+        interpreter = cls("", ram_type)
+        with memoryview(data) as view:
+            magic, length = BINARY_HEADER.unpack_from(view)
+            if magic != BINARY_MAGIC:
+                raise SyntaxError("Not a binary QFTASM program")
+            with view[BINARY_HEADER.size:] as body:
+                if len(body) != length * BINARY_INSTRUCTION.size:
+                    raise SyntaxError("Expected %d instructions, got %d bytes"%(length, len(body)))
+                interpreter.decoded = [(op_id, ((layers & 3, a), (layers >> 2 & 3, b), (layers >> 4, d)))
+                                       for op_id, layers, a, b, d in BINARY_INSTRUCTION.iter_unpack(body)]
+        return interpreter
+
+    @classmethod
+    def load(cls, path: str, ram_type: type = None) -> "Interpreter":
+        """
+        Load a binary program from a file, mapped into memory rather than read
+
+        :param path:
+        :param ram_type:
+        :return:
+        """
+        with open(path, "rb") as binary_file:
+            with mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return cls.from_binary(data, ram_type)
+
+    def to_binary(self) -> bytes:
+        """
+        Encode the program in the binary format read by from_binary
+
+        :return:
+        """
+        records = [BINARY_HEADER.pack(BINARY_MAGIC, len(self.decoded))]
+        for op_id, ((a_layers, a), (b_layers, b), (d_layers, d)) in self.decoded:
+            records.append(BINARY_INSTRUCTION.pack(op_id, a_layers | b_layers << 2 | d_layers << 4, a, b, d))
+        return b"".join(records)
+
+    def to_text(self) -> str:
+        """
+        The program as QFTASM source, without comments
+
+        :return:
+        """
+        unfix_value = self.ram.unfix_value
+        # Literals are written signed, as the compiler does
+        return "\n".join("%d. %s %s;"%(i, self.opcode_names[op_id],
+                                         " ".join(" ABC"[layers].strip() + str(address if layers else unfix_value(address))
+                                                  for layers, address in operands))
+                         for i, (op_id, operands) in enumerate(self.decoded))
+
+    def build_tokens(self):
+        """
+        Build the reference engine's tokens from the decoded instructions
+
+        :return:
+        """
+        self.tokens = [(self.opcodes[self.opcode_names[op_id]],
+                        [RamLocation(self.ram, layers, address) for layers, address in operands])
+                       for op_id, operands in self.decoded]
+        return self.tokens
+
+    def run(self, engine: str = "reference", max_cycles: int = None):
+        """
+        Run the program until it steps past its last instruction or a hook halts it
+
+        Calling run again carries on from where the last run stopped.
+
+        :param engine:
+        :param max_cycles: most instructions to run before stopping
+        :return: "end", "cycles" if max_cycles ran out, or the reason the program was halted with
+        """
+        try:
+            self.engines[engine](sys.maxsize if max_cycles is None else max_cycles)
+        except Halt as halt:
+            self.pc = halt.pc
+            return halt.reason
+        return "end" if self.pc >= len(self.decoded) else "cycles"
+
+    def step(self, n: int = 1, engine: str = "reference"):
+        """
+        Run the next n instructions
+
+        :param n:
+        :param engine:
+        :return: see run
+        """
+        return self.run(engine, n)
+
+    def get_state(self) -> dict:
+        """
+        Everything needed to resume the program, as plain ints
+
+        :return:
+        """
+        return {"pc": self.pc, "cycles": self.cycles, "ram": self.ram.dump()}
+
+    def set_state(self, state: dict):
+        """
+        Resume from a state returned by get_state
+
+        :param state:
+        :return:
+        """
+        self.pc = state["pc"]
+        self.cycles = state["cycles"]
+        # Keys become strings if the state went through JSON
+        self.ram.load({int(address): value for address, value in state["ram"].items()})
+
+    def run_decoded(self, max_cycles: int):
+        """
+        Run the program using one specialised handler per instruction
+
+        Each handler reads its operands, steps the PC and then does its write,
+        returning the index of the next instruction to run.
+        This matches run_reference, where the next instruction is selected
+        before the queued one is executed.
+        """
+        steps = self.build_steps()
+        pc = self.pc
+        done = 0
+        try:
+            for done in range(max_cycles):
+                pc = steps[pc]()
+            else:
+                done = max_cycles
+        except IndexError:
+            # Stepping past the last instruction ends the program
+            if pc < len(steps):
+                raise
+        except Halt:
+            done += 1
+            raise
+        finally:
+            self.pc = pc
+            self.cycles += done
+
+    def build_steps(self):
+        """
+        Build the specialised handler for each instruction
+
+        The handlers and compiled blocks are kept between runs until hooks are
+        added to the RAM, as they are specialised to the hooked addresses.
+
+        :return:
+        """
+        ram = self.ram
+        if self.steps is not None and self.compiled_for == (ram.store, set(ram.hooks)):
+            return self.steps
+        self.compiled_for = ram.store, set(ram.hooks)
+        self.blocks = None
+        self.steps = []
+        for op_id, operands in self.decoded:
+            modes = tuple(layers for layers, address in operands)
+            factory = get_handler_factory(op_id, modes, type(ram))
+            self.steps.append(factory(*(address for layers, address in operands), ram, ram._contents))
+        return self.steps
+
+    def run_jit(self, max_cycles: int):
+        """
+        Run the program as compiled blocks, falling back to single steps
+
+        Blocks assume the PC in RAM matches the instruction they start at,
+        which is not the case after a delay slot or a computed write changes
+        the PC. Blocks flag that by returning the inverted PC, and the
+        instructions are then run one at a time with the decoded handlers.
+        """
+        steps = self.build_steps()
+        len_steps = len(steps)
+        if self.blocks is None:
+            self.tally = [0]
+            self.blocks = [self.lazy_block(pc) for pc in range(len_steps)]
+        blocks = self.blocks
+        ram = self.ram
+        # Blocks add the instructions they run to the tally
+        tally = self.tally
+        tally[0] = 0
+        # Blocks only run while the budget covers the longest one
+        limit = max_cycles - self.max_block_length
+        # Resuming in a delay slot needs single steps until the PC is back in sync
+        pc = self.pc if ram[0] == self.pc else ~self.pc
+        try:
+            while 1:
+                while 0 <= pc < len_steps and tally[0] <= limit:
+                    pc = blocks[pc]()
+                if pc >= len_steps:
+                    break
+                if pc >= 0:
+                    # Near the end of the budget
+                    while pc < len_steps and tally[0] < max_cycles:
+                        tally[0] += 1
+                        pc = steps[pc]()
+                    break
+                pc = ~pc
+                while pc < len_steps and ram[0] != pc and tally[0] < max_cycles:
+                    tally[0] += 1
+                    pc = steps[pc]()
+        finally:
+            self.pc = pc
+            self.cycles += tally[0]
+
+    def lazy_block(self, entry: int):
+        """
+        Placeholder that compiles the block at `entry` the first time it is run
+
+        :param entry:
+        :return:
+        """
+        def block():
+            self.blocks[entry] = self.compile_block(entry)
+            return self.blocks[entry]()
+        return block
+
+    def compile_block(self, entry: int, max_length: int = None):
+        """
+        Generate a function running the instructions from `entry`
+
+        While the PC is known it is only written back to RAM when something
+        could read it, and unconditional jumps to literal addresses are
+        followed into their target.
+        The block stops after the delay slot of any other jump, after a
+        computed write that turns out to be to the PC, or when it loops.
+
+        :param entry:
+        :param max_length:
+        :return: a function running the block and returning the next PC
+        """
+        max_length = max_length or self.max_block_length
+        ram_type = type(self.ram)
+        constants = {"negative_bit": ram_type.negative_bit, "max_value": ram_type.max_value}
+        hooks = self.ram.hooks
+        lines = []
+
+        def read(layers, address, pc):
+            if layers == 0:
+                return str(address)
+            source = str(pc) if address == 0 and pc is not None else ram_type.read_source.format(address)
+            for i in range(layers - 1):
+                source = ram_type.read_source.format(source)
+            return source
+
+        def substitute(template, name, layers, address, pc):
+            # Operands are read before the PC steps, so only inline those
+            # that are used once and cannot read the PC
+            source = read(layers, address, pc)
+            pattern = r"\b%s\b"%name
+            uses = len(re.findall(pattern, template))
+            if uses == 0:
+                return template
+            if layers == 0 or (layers == 1 and (address != 0 or pc is not None) and uses == 1):
+                return re.sub(pattern, "(%s)"%source, template)
+            lines.append("%s = %s"%(name, source))
+            return template
+
+        def write(dest, value, condition):
+            if dest in hooks or (dest == "d" and hooks):
+                # A hook could halt the program, so bring the tally up to date first
+                count()
+                template = [ram_type.write_source]
+            else:
+                template = ram_type.inline_write_source
+            indent = ""
+            if condition is not None:
+                lines.append("if %s:"%condition)
+                indent = "    "
+            for line in template:
+                lines.append(indent + line.format(dest, value, **constants))
+
+        def count():
+            # Add the instructions run since the last count to the tally
+            if len(seen) > counted[0]:
+                lines.append("tally[0] += %d"%(len(seen) - counted[0]))
+            counted[0] = len(seen)
+
+        # The instruction to run next, and the PC in RAM when it runs if known
+        i, pc = entry, entry
+        seen = set()
+        counted = [0]
+        while i < len(self.decoded) and (i, pc) not in seen and len(seen) < max_length:
+            seen.add((i, pc))
+            op_id, ((a_layers, a), (b_layers, b), (d_layers, d)) = self.decoded[i]
+            condition, value = OPERATIONS[op_id]
+            value = value.format(**constants)
+            if condition is not None:
+                condition = condition.format(**constants)
+                if a_layers == 0:
+                    # The test is a literal, so the write either always or never happens
+                    if not eval(condition, {"a": a}):
+                        value = None
+                    condition = None
+            if pc is not None and max(a_layers, b_layers, d_layers) > 1:
+                # Indirect reads could land on the PC
+                lines.append(ram_type.pc_source.format(pc, **constants))
+            if value is not None:
+                if condition is not None:
+                    lines.append("a = %s"%read(a_layers, a, pc))
+                value = substitute(value, "a", a_layers, a, pc)
+                value = substitute(value, "b", b_layers, b, pc)
+            dest = d
+            if d_layers and value is not None:
+                lines.append("d = %s"%read(d_layers, d, pc))
+                dest = "d"
+            if pc is None:
+                # After a jump the PC can only be found at runtime, so stop here
+                lines.append(ram_type.step_source.format(**constants))
+                count()
+                if value is not None:
+                    write(dest, value, condition)
+                if dest == "d":
+                    lines.append("if d == 0: return ~pc")
+                elif dest == 0 and value is not None:
+                    lines.append("return ~pc")
+                lines.append("return pc")
+                break
+            i = pc = pc + 1
+            if value is None:
+                continue
+            if dest == "d" or (dest == 0 and condition is not None) or dest in hooks:
+                # The PC could be read, or the hook could halt the program
+                lines.append(ram_type.pc_source.format(pc, **constants))
+            write(dest, value, condition)
+            if dest == "d":
+                if len(seen) > counted[0]:
+                    # Counted here without updating `counted`, as the block carries on otherwise
+                    lines.append("if d == 0: tally[0] += %d; return ~%d"%(len(seen) - counted[0], i))
+                else:
+                    lines.append("if d == 0: return ~%d"%i)
+            elif dest == 0:
+                if condition is None and re.fullmatch(r"[\d()+\-&|^~<> ]*", value):
+                    # Jumping to a literal, so the PC is known in the delay slot
+                    pc = eval(value) & ram_type.max_value
+                else:
+                    pc = None
+        else:
+            count()
+            if i >= len(self.decoded):
+                if pc is not None:
+                    lines.append(ram_type.pc_source.format(pc, **constants))
+                lines.append("return %d"%i)
+            else:
+                lines.append(ram_type.pc_source.format(pc, **constants))
+                lines.append("return %d"%(i if i == pc else ~i))
+        source = "\n".join(["def factory(ram, mem, tally):",
+                            "    %s"%ram_type.prelude_source,
+                            "    def block():"] +
+                           ["        " + line for line in lines] +
+                           ["    return block"])
+        namespace = {}
+        exec(compile(source, "<block %d>"%entry, "exec"), namespace)
+        return namespace["factory"](self.ram, self.ram._contents, self.tally)
+
+    def run_reference(self, max_cycles: int):
+        if self.tokens is None:
+            self.build_tokens()
         len_tokens = len(self.tokens)
-        # the operation in queue
+        pc = self.pc
+        cycles = 0
 
-        opcode = None
+        try:
+            while pc < len_tokens and cycles < max_cycles:
+                # the operation in queue
+                opcode, operands = self.tokens[pc]
 
-        while 1:
-            if self.ram._contents[0] >= len_tokens:
-                qopcode = None
-            else:
-                qopcode, qoperands = self.tokens[self.ram._contents[0]]
+                # read into memory
+                operands = list(map(RamLocation.__call__, operands))
 
-            # starting condition
-            if opcode is not None:
+                # the next operation is selected before this one runs
+                pc = self.ram.increment_pc()
+                cycles += 1
                 opcode(*operands)
-            #print(self.ram)
-
-            # ending condition
-            if qopcode is None:
-                break
-
-            # read into memory
-            qoperands = list(map(RamLocation.__call__, qoperands))
-            opcode, operands = qopcode, qoperands
-            self.ram._contents[0]+=1
+                #print(self.ram)
+        finally:
+            self.pc = pc
+            self.cycles += cycles
 
         #print("Done!")
 
@@ -100,9 +555,21 @@ class RAM():
     address_size = 16
     negative_bit = 1 << (address_size - 1)
     max_value = (1 << address_size) - 1
+    # Source templates used to build the decoded engine's handlers
+    prelude_source = "get = mem.get; store = ram.store"
+    read_source = "get({}, 0)"
+    step_source = "pc = get(0, 0) + 1; mem[0] = pc"
+    pc_source = "mem[0] = {}"
+    write_source = "store({}, {})"
+    inline_write_source = ["v = {1}",
+                           "if v: mem[{0}] = v & {max_value}",
+                           "else: mem.pop({0}, None)"]
 
     def __init__(self):
         self._contents = {0:0}
+        # Callbacks for writes to specific addresses, see add_hook
+        self.hooks = {}
+        self.store = self.write
 
     def __repr__(self):
         return repr(self._contents)
@@ -124,14 +591,79 @@ class RAM():
             return 0
 
     def __setitem__(self, key, value):
+        self.store(key, value)
+
+    def write(self, key, value):
         self._contents[key] = self.fix_value(value)
-        if key == 1:
-            #print("Set 1 to", self._contents[key])
-            if self._contents[key] == 211:
-                exit()
         if value == 0:
             del self._contents[key]
 
+    def write_hooked(self, key, value):
+        if key not in self.hooks:
+            self.write(key, value)
+            return
+        # The PC is stepped before the write, so this is the next instruction
+        pc = self[0]
+        self.write(key, value)
+        value = self[key]
+        try:
+            for hook in self.hooks[key]:
+                hook(key, value)
+        except Halt as halt:
+            halt.pc = pc
+            raise
+
+    def add_hook(self, addresses, callback):
+        """
+        Call `callback(address, value)` after every write to the given addresses
+
+        Writes to addresses without a hook skip the check entirely.
+        A hook can stop the program by raising Halt.
+
+        :param addresses: a single address or an iterable of them, eg. a range
+        :param callback:
+        :return:
+        """
+        if isinstance(addresses, int):
+            addresses = [addresses]
+        for address in addresses:
+            self.hooks.setdefault(self.fix_value(address), []).append(callback)
+        self.store = self.write_hooked
+
+    def remove_hooks(self):
+        self.hooks = {}
+        self.store = self.write
+
+    def dump(self) -> dict:
+        """
+        Every address holding a non-zero value
+
+        :return:
+        """
+        return {address: value for address, value in self._contents.items() if value}
+
+    def load(self, contents: dict):
+        """
+        Replace the contents of RAM without calling any hooks
+
+        :param contents: address: value
+        :return:
+        """
+        self._contents.clear()
+        for address, value in contents.items():
+            self.write(address, value)
+
+    def increment_pc(self):
+        """
+        Step the PC on by one instruction
+
+        :return: the new PC
+        """
+        # Jumping to 0 removes the PC from RAM, so read it back with a default
+        pc = self[0] + 1
+        self._contents[0] = pc
+        return pc
+
     def fix_value(self, value):
         if value < 0:
             value = self.max_value+value+1
@@ -146,11 +678,123 @@ class RAM():
         return value & self.negative_bit == 0
 
 
+def operand_source(ram_type: type, layers: int, name: str) -> str:
+    """
+    Python expression reading an operand with `layers` levels of indirection
+    """
+    source = name
+    for i in range(layers):
+        source = ram_type.read_source.format(source)
+    return source
+
+
+def get_handler_factory(op_id: int, modes: tuple, ram_type: type):
+    """
+    Build (and cache) the handler factory for an opcode, addressing modes and RAM type
+
+    The factory takes the three operand addresses followed by the RAM and its
+    contents and returns a handler for a single instruction.
+    """
+    key = op_id, modes, ram_type
+    if key in _handler_factories:
+        return _handler_factories[key]
+    condition, value = OPERATIONS[op_id]
+    constants = {"negative_bit": ram_type.negative_bit, "max_value": ram_type.max_value}
+    write = ram_type.write_source.format("d", value.format(**constants))
+    if condition is not None:
+        write = "if %s: %s"%(condition.format(**constants), write)
+    source = "\n".join([
+        "def factory(x, y, z, ram, mem):",
+        "    %s"%ram_type.prelude_source,
+        "    def step():",
+        "        a = %s"%operand_source(ram_type, modes[0], "x"),
+        "        b = %s"%operand_source(ram_type, modes[1], "y"),
+        "        d = %s"%operand_source(ram_type, modes[2], "z"),
+        "        %s"%ram_type.step_source.format(**constants),
+        "        %s"%write,
+        "        return pc",
+        "    return step",
+    ])
+    namespace = {}
+    exec(compile(source, "<handler %s %s>"%(Interpreter.opcode_names[op_id], modes), "exec"), namespace)
+    _handler_factories[key] = namespace["factory"]
+    return _handler_factories[key]
+
+
+class ArrayRAM(RAM):
+    """
+    RAM backed by a preallocated array of 16 bit words covering every address
+
+    Memory use is fixed, and reads and writes are plain indexing.
+    """
+    prelude_source = "store = ram.store"
+    read_source = "mem[{}]"
+    step_source = "pc = mem[0] + 1; mem[0] = pc & {max_value}"
+    pc_source = "mem[0] = {} & {max_value}"
+    inline_write_source = ["mem[{0}] = ({1}) & {max_value}"]
+
+    def __init__(self):
+        super().__init__()
+        self._contents = array("H", bytes(2 << self.address_size))
+
+    def __repr__(self):
+        return repr({key: value for key, value in enumerate(self._contents) if value or key == 0})
+
+    def __str__(self):
+        rtn = ["RAMDUMP"]
+        for key, value in enumerate(self._contents):
+            if value or key == 0:
+                rtn.append("%d: %d"%(key, value))
+        return "\n".join(rtn)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._contents[item].tolist()
+        if isinstance(item, tuple):
+            return [self._contents[a] for a in item]
+        return self._contents[item]
+
+    def write(self, key, value):
+        self._contents[key] = value & self.max_value
+
+    def dump(self):
+        return {address: value for address, value in enumerate(self._contents) if value}
+
+    def load(self, contents):
+        # Handlers hold on to the array, so clear it in place
+        self._contents[:] = array("H", bytes(len(self._contents) * 2))
+        for address, value in contents.items():
+            self.write(address, value)
+
+    def increment_pc(self):
+        # The PC may step past the last address, which halts the program,
+        # but only the wrapped value fits in the array
+        pc = self._contents[0] + 1
+        self._contents[0] = pc & self.max_value
+        return pc
+
+
+def halt_on(value: int, reason: str = "halt"):
+    """
+    Hook that halts the program when `value` is written
+
+    :param value:
+    :param reason:
+    :return:
+    """
+    value &= RAM.max_value
+
+    def hook(address, written):
+        if written == value:
+            raise Halt(reason)
+    return hook
+
+
 class RamLocation():
-    def __init__(self, ram: RAM, address: str):
+    def __init__(self, ram: RAM, layers: int, address: int):
         self.ram = ram
-        self.layers = "ABC".find(address[0]) + 1
-        self.address = self.ram.fix_value(int(address[self.layers > 0:]))
+        self.layers = layers
+        self.address = address
         self.range_layers = list(range(self.layers))
 
     def __call__(self):
@@ -163,5 +807,9 @@ class RamLocation():
 
 if __name__ == "__main__":
     with open(sys.argv[1]) as assembly_file:
-        interpreter = Interpreter(assembly_file.read())
-        interpreter.run()
+        interpreter = Interpreter(assembly_file)
+    # Optional address=value pairs to halt on, eg. 1=211 for primes.qftasm
+    for arg in sys.argv[2:]:
+        address, value = map(int, arg.split("="))
+        interpreter.ram.add_hook(address, halt_on(value))
+    print(interpreter.run())
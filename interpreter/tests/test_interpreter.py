@@ -1,7 +1,17 @@
+import json
+import os
+import tempfile
 import unittest
 import sys
 sys.path.insert(1,'..')
-from interpreter import Interpreter
+from interpreter import Interpreter, ArrayRAM, Halt, halt_on, OPERATIONS
+from cfg import ControlFlowGraph
+from batch import Job, run_batch
+try:
+    import numpy as np
+    from vector import VectorInterpreter, OPERATIONS as VECTOR_OPERATIONS
+except ImportError:
+    VectorInterpreter = None
 
 class TestInterpreter(unittest.TestCase):
     def setUp(self):
@@ -87,15 +97,331 @@ class TestInterpreter(unittest.TestCase):
         self.run_prg("""0. MNZ 0 3 1;
                         1. MNZ 1 4 2;
                         2. MNZ -1 A0 3;
-                        4. MNZ -1 1 5;""")
+                        3. MNZ -1 1 5;""")
         self.assertEqual(self.ram[:6], [4, 0, 4, 2, 0, 1])
 
     def test_point(self):
         self.run_prg("""0. MNZ -1 3 1;
                         1. MNZ 1 4 3;
                         2. MNZ 1 2 4;
-                        4. MNZ -1 C1 5;""")
+                        3. MNZ -1 C1 5;""")
         self.assertEqual(self.ram[1:6], [3,0,4,2,2])
 
+    def test_loop(self):
+        self.run_prg("""0. MLZ -1 10 1;
+                        1. SUB A1 1 1;
+                        2. ADD A2 A1 2;
+                        3. MNZ A1 0 0;
+                        4. MLZ -1 A0 3;""")
+        self.assertEqual(self.ram[1:4], [0, 45, 4])
+
+    def test_jump_in_delay_slot(self):
+        self.run_prg("""0. MLZ -1 3 0;
+                        1. MLZ -1 5 0;
+                        2. MLZ -1 1 1;
+                        3. MLZ -1 1 2;
+                        4. MLZ -1 1 3;
+                        5. MLZ -1 1 4;
+                        6. MLZ -1 1 5;""")
+        self.assertEqual(self.ram[1:6], [0, 0, 1, 0, 1])
+
+
+class TestDecodedInterpreter(TestInterpreter):
+    def run_prg(self, inp):
+        self.interpreter.__init__(inp)
+        self.interpreter.run("decoded")
+        self.ram = self.interpreter.ram
+
+
+class TestJitInterpreter(TestInterpreter):
+    def run_prg(self, inp):
+        self.interpreter.__init__(inp)
+        self.interpreter.run("jit")
+        self.ram = self.interpreter.ram
+
+    def test_computed_jump(self):
+        self.run_prg("""0. MLZ -1 4 1;
+                        1. ADD A1 0 A2;
+                        2. MLZ -1 1 3;
+                        3. MLZ -1 1 4;
+                        4. MLZ -1 1 5;
+                        5. MLZ -1 1 6;""")
+        self.assertEqual(self.ram[:7], [6, 4, 0, 1, 0, 0, 1])
+
+
+class TestArrayRAMInterpreter(TestInterpreter):
+    def run_prg(self, inp, engine="reference"):
+        self.interpreter.__init__(inp, ArrayRAM)
+        self.interpreter.run(engine)
+        self.ram = self.interpreter.ram
+
+    def test_engines(self):
+        for engine in ("decoded", "jit"):
+            self.run_prg("""0. MLZ -1 10 1;
+                            1. SUB A1 1 1;
+                            2. ADD A2 A1 2;
+                            3. MNZ A1 0 0;
+                            4. MLZ -1 A0 3;""", engine)
+            self.assertEqual(self.ram[1:4], [0, 45, 4])
+
+    def test_halt_past_end(self):
+        self.run_prg("""0. MLZ -1 -1 0;
+                        1. MLZ -1 5 1;
+                        2. MLZ -1 6 1;""")
+        self.assertEqual(self.ram[1], 5)
+        self.assertEqual(len(self.ram._contents), 1 << 16)
+
+
+@unittest.skipIf(VectorInterpreter is None, "NumPy is not installed")
+class TestVectorInterpreter(TestInterpreter):
+    images = [{}, {1: 3, 2: 65535, 3: 2, 4: 1}, {1: 1, 2: 5, 5: 32768, 6: 4}]
+
+    def run_prg(self, inp):
+        vector = VectorInterpreter(inp, len(self.images))
+        for lane, image in enumerate(self.images):
+            vector.load(lane, image)
+        vector.run()
+        for lane, image in enumerate(self.images):
+            expected = Interpreter(inp, ArrayRAM)
+            expected.ram.load(image)
+            expected.run()
+            self.assertEqual(vector.lane_ram(lane).dump(), expected.ram.dump())
+            self.assertEqual((vector.pc[lane], vector.cycles[lane]), (expected.pc, expected.cycles))
+        self.ram = vector.lane_ram(0)
+
+    def test_divergent_lanes(self):
+        # Each lane loops as many times as the value in address 10
+        self.images = [{10: n} for n in (3, 1, 7, 2, 12)]
+        self.run_prg(TestHooks.program.replace("MLZ -1 3 1", "MLZ -1 A10 1"))
+
+
+@unittest.skipIf(VectorInterpreter is None, "NumPy is not installed")
+class TestVectorOperations(unittest.TestCase):
+    def test_operations(self):
+        # The vectorised opcodes give the same as interpreter.OPERATIONS, which the other engines run
+        constants = {"negative_bit": ArrayRAM.negative_bit, "max_value": ArrayRAM.max_value}
+        values = [0, 1, 2, 3, 15, 16, 17, 31, 32, 33, 4660, 32767, 32768, 32769, 65534, 65535]
+        a = np.array([x for x in values for y in values], dtype=np.int64)
+        b = np.array([y for x in values for y in values], dtype=np.int64)
+        for name, (condition, value), (vector_condition, vector_value) in zip(Interpreter.opcode_names, OPERATIONS,
+                                                                              VECTOR_OPERATIONS):
+            with self.subTest(opcode=name):
+                self.assertEqual(condition is None, vector_condition is None)
+                if condition is not None:
+                    expected = [bool(eval(condition.format(**constants), {"a": x})) for x in a.tolist()]
+                    self.assertEqual(vector_condition(a).tolist(), expected)
+                expected = [eval(value.format(**constants), {"a": x, "b": y}) & ArrayRAM.max_value
+                            for x, y in zip(a.tolist(), b.tolist())]
+                self.assertEqual((vector_value(a, b) & ArrayRAM.max_value).tolist(), expected)
+
+
+class TestParse(unittest.TestCase):
+    def test_line_numbers(self):
+        with self.assertRaises(SyntaxError):
+            Interpreter("""0. MNZ 0 3 1;
+                           2. MNZ 1 4 2;""")
+
+    def test_unknown_opcode(self):
+        with self.assertRaises(SyntaxError):
+            Interpreter("0. MOV 0 3 1;")
+
+    def test_stream(self):
+        read = []
+
+        def lines():
+            for line in ["0. MNZ 1 3 1;\n", "\n", "; comment\n", "1. MNZ 1 4;\n", "2. MNZ 1 5 3;\n"]:
+                read.append(line)
+                yield line
+        with self.assertRaises(SyntaxError) as context:
+            Interpreter(lines())
+        self.assertEqual(context.exception.lineno, 4)
+        self.assertEqual(len(read), 4)
+        interpreter = Interpreter(iter(read[:3]))
+        interpreter.run()
+        self.assertEqual(interpreter.ram[1], 3)
+
+
+class TestBinary(unittest.TestCase):
+    program = """0. MLZ -1 10 1;
+                 1. SUB A1 1 1;
+                 2. ADD A2 A1 2;
+                 3. MNZ A1 0 0;
+                 4. MLZ -1 A0 3;
+                 5. ANT B65534 C3 A4;"""
+
+    def test_round_trip(self):
+        binary = Interpreter(self.program).to_binary()
+        self.assertEqual(len(binary), 8 + 8 * 6)
+        text = Interpreter.from_binary(binary).to_text()
+        self.assertEqual(text.splitlines(), [line.strip() for line in self.program.splitlines()])
+        self.assertEqual(Interpreter(text).to_binary(), binary)
+
+    def test_run(self):
+        for engine in ("reference", "decoded", "jit"):
+            interpreter = Interpreter.from_binary(Interpreter(self.program).to_binary())
+            self.assertEqual(interpreter.run(engine), "end")
+            self.assertEqual(interpreter.ram[1:4], [0, 45, 4])
+
+    def test_load(self):
+        handle, path = tempfile.mkstemp(".qftb")
+        with os.fdopen(handle, "wb") as binary_file:
+            binary_file.write(Interpreter(self.program).to_binary())
+        try:
+            interpreter = Interpreter.load(path)
+        finally:
+            os.remove(path)
+        interpreter.run("decoded")
+        self.assertEqual(interpreter.ram[1:4], [0, 45, 4])
+
+    def test_not_binary(self):
+        with self.assertRaises(SyntaxError):
+            Interpreter.from_binary(self.program.encode())
+        with self.assertRaises(SyntaxError):
+            Interpreter.from_binary(Interpreter(self.program).to_binary()[:-1])
+
+
+class TestHooks(unittest.TestCase):
+    # Counts 3 down to 0, writing each value to address 1 and the total to 2
+    program = """0. MLZ -1 3 1;
+                 1. SUB A1 1 1;
+                 2. ADD A2 A1 2;
+                 3. MNZ A1 0 0;
+                 4. MLZ -1 A0 3;"""
+
+    def run_hooked(self, addresses, callback):
+        for ram_type in (None, ArrayRAM):
+            for engine in ("reference", "decoded", "jit"):
+                interpreter = Interpreter(self.program, ram_type)
+                interpreter.ram.add_hook(addresses, callback)
+                yield engine, interpreter, interpreter.run(engine)
+
+    def test_output(self):
+        written = []
+        for engine, interpreter, reason in self.run_hooked(1, lambda address, value: written.append(value)):
+            with self.subTest(engine=engine, ram=type(interpreter.ram).__name__):
+                self.assertEqual(reason, "end")
+                self.assertEqual(written, [3, 2, 1, 0])
+                self.assertEqual(interpreter.ram[1:3], [0, 3])
+            written = []
+
+    def test_halt(self):
+        for engine, interpreter, reason in self.run_hooked(range(2, 4), halt_on(3, "done")):
+            with self.subTest(engine=engine, ram=type(interpreter.ram).__name__):
+                self.assertEqual(reason, "done")
+                # Halted as soon as the total reaches 3, on the second time round
+                self.assertEqual(interpreter.ram[:3], [3, 1, 3])
+
+    def test_halt_exception(self):
+        def hook(address, value):
+            raise Halt()
+        interpreter = Interpreter(self.program)
+        interpreter.ram.add_hook(0, hook)
+        self.assertEqual(interpreter.run("jit"), "halt")
+        self.assertEqual(interpreter.ram[:3], [0, 2, 2])
+
+
+class TestResume(unittest.TestCase):
+    program = TestHooks.program.replace("MLZ -1 3 1", "MLZ -1 10 1")
+
+    def interpreters(self):
+        for ram_type in (None, ArrayRAM):
+            for engine in ("reference", "decoded", "jit"):
+                expected = Interpreter(self.program, ram_type)
+                expected.run(engine)
+                yield engine, Interpreter(self.program, ram_type), expected
+
+    def test_max_cycles(self):
+        for engine, interpreter, expected in self.interpreters():
+            self.assertEqual(interpreter.run(engine, 7), "cycles")
+            self.assertEqual(interpreter.cycles, 7)
+            self.assertEqual(interpreter.run(engine), "end")
+            self.assertEqual(interpreter.cycles, expected.cycles)
+            self.assertEqual(interpreter.ram[1:4], [0, 45, 4])
+
+    def test_step(self):
+        for engine, interpreter, expected in self.interpreters():
+            while interpreter.step(engine=engine) == "cycles":
+                pass
+            self.assertEqual(interpreter.cycles, expected.cycles)
+            self.assertEqual(interpreter.ram[:4], expected.ram[:4])
+
+    def test_state(self):
+        for engine, interpreter, expected in self.interpreters():
+            # Stop in the delay slot of the loop's jump
+            interpreter.run(engine, 8)
+            self.assertNotEqual(interpreter.pc, interpreter.ram[0])
+            resumed = Interpreter(self.program, type(interpreter.ram))
+            resumed.set_state(json.loads(json.dumps(interpreter.get_state())))
+            self.assertEqual(resumed.run(engine), "end")
+            self.assertEqual(resumed.get_state(), expected.get_state())
+
+    def test_resume_after_halt(self):
+        for engine, interpreter, expected in self.interpreters():
+            interpreter.ram.add_hook(2, halt_on(35))
+            self.assertEqual(interpreter.run(engine), "halt")
+            self.assertEqual(interpreter.ram[1:3], [5, 35])
+            self.assertEqual(interpreter.run(engine), "end")
+            self.assertEqual(interpreter.get_state(), expected.get_state())
+
+
+class TestBatch(unittest.TestCase):
+    def test_run_batch(self):
+        # The loop counts down from its input in address 10
+        program = TestHooks.program.replace("MLZ -1 3 1", "MLZ -1 A10 1")
+        jobs = [Job(program, ram={10: n}, array_ram=n % 2, addresses=range(1, 4)) for n in range(1, 9)]
+        jobs.append(Job(program, ram={10: 8}, halts={2: 18}))
+        jobs.append(Job(program, max_cycles=7, ram={10: 8}))
+        results = run_batch(jobs, workers=2)
+        self.assertEqual([result["ram"] for result in results[:8]],
+                         [{3: 4, 2: n * (n - 1) // 2} if n > 1 else {3: 4} for n in range(1, 9)])
+        self.assertEqual([result["reason"] for result in results[-3:]], ["end", "halt", "cycles"])
+        self.assertEqual(results[-2]["ram"], jobs[-2].run()["ram"])
+        self.assertEqual(results[-1]["cycles"], 7)
+
+
+class TestControlFlowGraph(unittest.TestCase):
+    def test_loop(self):
+        interpreter = Interpreter("""0. MLZ -1 10 1;
+                                     1. SUB A1 1 1;
+                                     2. ADD A2 A1 2;
+                                     3. MNZ A1 0 0;
+                                     4. MLZ -1 A0 3;
+                                     5. MLZ -1 1 4;""")
+        cfg = ControlFlowGraph.from_interpreter(interpreter)
+        self.assertEqual(cfg.leaders, [0, 1, 5])
+        self.assertEqual(cfg.jump_targets, {3: 1})
+        loop = cfg.block_at(3)
+        self.assertEqual((loop.start, loop.end, loop.jump, loop.delay_slot), (1, 5, 3, 4))
+        self.assertEqual(loop.successors, [1, 5])
+        self.assertEqual(loop.predecessors, [0, 1])
+
+    def test_computed_jump(self):
+        cfg = ControlFlowGraph.from_text("""0. MLZ -1 2 A5;
+                                            1. MLZ -1 7 0;
+                                            2. MLZ 0 0 0;
+                                            3. MLZ -1 1 1;
+                                            4. MLZ -1 -2 0;
+                                            5. MLZ 0 0 0;
+                                            6. MLZ -1 1 2;
+                                            7. MLZ -1 1 3;
+                                            8. MLZ -1 1 4;
+                                            9. MLZ -1 B5 0;
+                                            10. MLZ 0 0 0;""")
+        self.assertEqual(cfg.address_taken, [3])
+        self.assertTrue(cfg.blocks[8].computed)
+        self.assertEqual(cfg.blocks[8].successors, [3])
+        self.assertTrue(cfg.blocks[0].computed_writes)
+        self.assertEqual(cfg.reachable(), {0, 3, 8})
+
+    def test_text(self):
+        cfg = ControlFlowGraph.from_text("0. MLZ -1 1 0; start\n\n1. MLZ 0 0 0;\n2. ADD A1 -1 1;")
+        self.assertEqual([inst.comment for inst in cfg.instructions], ["start", "", ""])
+        self.assertEqual(cfg.instructions[2].operands, [(1, 1), (0, 65535), (0, 1)])
+        # Lines the interpreter wouldn't run aren't accepted either
+        for text in ("0. MLZ -1 1 0", "1. MLZ -1 1 0;", "0. MLZ -1 1;"):
+            with self.assertRaises(SyntaxError):
+                ControlFlowGraph.from_text(text)
+
+
 if __name__ == '__main__':
     unittest.main()
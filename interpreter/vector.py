@@ -0,0 +1,127 @@
+"""
+Run one QFTASM program over many RAM images at once with NumPy
+
+Each RAM image is a lane, a row of a 2-D uint16 array, and each instruction
+is run as a handful of array operations across every lane at that
+instruction. Lanes whose PC has diverged wait until the lowest PC catches up
+with them, which is where branches of structured code come back together.
+
+Lanes behave like Interpreter with ArrayRAM.
+"""
+from array import array
+
+import numpy as np
+
+from interpreter import Interpreter, ArrayRAM
+
+# Each lane is the RAM of an ArrayRAM
+max_value = ArrayRAM.max_value
+negative_bit = ArrayRAM.negative_bit
+
+# (condition, value) for each opcode, in the same order as Interpreter.opcode_names, matching interpreter.OPERATIONS
+# Operands are int64 arrays, and shifts are capped so they stay within 64 bits
+OPERATIONS = [(lambda a: a != 0, lambda a, b: b),
+              (lambda a: (a & negative_bit) != 0, lambda a, b: b),
+              (None, lambda a, b: a + b),
+              (None, lambda a, b: a - b),
+              (None, lambda a, b: a & b),
+              (None, lambda a, b: a | b),
+              (None, lambda a, b: a ^ b),
+              (None, lambda a, b: a & ~b),
+              (None, lambda a, b: a << np.minimum(b, 32)),
+              (None, lambda a, b: np.where(a & negative_bit, a - max_value - 1, a) >> np.minimum(b, 32)),
+              (None, lambda a, b: a >> np.minimum(b, 32)),
+              ]
+
+
+class VectorInterpreter:
+    def __init__(self, inp: str, lanes: int):
+        """
+        Run `inp` over `lanes` RAM images, all zero until loaded
+
+        :param inp: QFTASM source
+        :param lanes:
+        """
+        self.decoded = Interpreter(inp).decoded
+        self.ram = np.zeros((lanes, max_value + 1), dtype=np.uint16)
+        # Lanes are indexed through the flattened RAM, which is quicker than 2-D indexing
+        self.flat_ram = self.ram.reshape(-1)
+        self.lanes = np.arange(lanes)
+        # The next instruction each lane runs, as in Interpreter.pc
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.cycles = np.zeros(lanes, dtype=np.int64)
+
+    def load(self, lane: int, contents: dict):
+        """
+        Set addresses of one lane's RAM
+
+        :param lane:
+        :param contents: address: value
+        :return:
+        """
+        for address, value in contents.items():
+            self.ram[lane, address & max_value] = value & max_value
+
+    def lane_ram(self, lane: int) -> ArrayRAM:
+        """
+        Copy of one lane's RAM
+
+        :param lane:
+        :return:
+        """
+        ram = ArrayRAM()
+        ram._contents = array("H", self.ram[lane].tobytes())
+        return ram
+
+    def run(self, max_steps: int = None):
+        """
+        Run until every lane steps past the last instruction
+
+        :param max_steps: most instructions to run, each over every lane at it
+        :return: whether each lane has finished
+        """
+        len_decoded = len(self.decoded)
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            pc = self.pc.min()
+            if pc >= len_decoded:
+                break
+            if self.pc.max() == pc:
+                self.execute(pc, self.lanes)
+            else:
+                self.execute(pc, np.flatnonzero(self.pc == pc))
+            steps += 1
+        return self.pc >= len_decoded
+
+    def execute(self, pc: int, lanes):
+        """
+        Run the instruction at `pc` in the given lanes
+
+        :param pc:
+        :param lanes: indices of lanes
+        :return:
+        """
+        op_id, ((a_layers, a), (b_layers, b), (d_layers, d)) = self.decoded[pc]
+        condition, operation = OPERATIONS[op_id]
+        flat_ram = self.flat_ram
+        # Index of address 0 of each lane in flat_ram
+        bases = lanes << 16
+        # Operands are read before the PC steps, as in Interpreter
+        a = self.read(bases, a_layers, a)
+        b = self.read(bases, b_layers, b)
+        d = self.read(bases, d_layers, d)
+        next_pc = flat_ram[bases].astype(np.int64) + 1
+        flat_ram[bases] = next_pc & max_value
+        self.pc[lanes] = next_pc
+        self.cycles[lanes] += 1
+        value = operation(a, b) & max_value
+        if condition is not None:
+            taken = condition(a)
+            bases, value, d = bases[taken], value[taken], d[taken]
+        flat_ram[bases + d] = value
+
+    def read(self, bases, layers: int, address: int):
+        value = np.full(len(bases), address, dtype=np.int64)
+        for i in range(layers):
+            value = self.flat_ram[bases + value].astype(np.int64)
+        return value